@@ -1,12 +1,104 @@
+import hashlib
 from pydantic import BaseModel, Field
 from pydantic_ai import Agent, ModelSettings
+from pydantic_ai.models.openai import OpenAIChatModelSettings
 
 class DataFilterer(BaseModel):
     rm_number: str = Field(description="The extracted or inferred RM number.")
     reasoning: str = Field(description="Briefly why you picked this RM.")
 
+
+def build_rm_descriptions(ccs_frameworks):
+    """ Build the framework directory the labeller maps queries onto
+
+    :param ccs_frameworks(pd.DataFrame): frameworks from fetch_all_ccs_frameworks
+    :return(str): one line per framework with its RM number, keywords, summary and pillar
+    """
+    return "\n".join([
+        f"RM: {r.rm_number} | "
+        f"Keywords: {r.keywords if 'keywords' in r and str(r.keywords).strip() else 'N/A'} | "
+        f"Summary: {r.summary} | "
+        f"Pillar: {r.pillar} ({r.category})"
+        for _, r in ccs_frameworks.iterrows()
+    ])
+
+
+def labeller_system_prompt(rm_descriptions):
+    return (
+        "You are a Senior Procurement Analyst. You are an expert across 200 government frameworks. "
+        "Your task is to map any user query—no matter how technical or niche—to the correct RM number. "
+        f"\n\n### MASTER FRAMEWORK DIRECTORY:\n{rm_descriptions}\n\n"
+        "### INSTRUCTIONS:\n"
+        "1. Identify the core industry or service in the query.\n"
+        "2. Match it to the most relevant RM description from the directory.\n"
+        "3. If the user mentions 'cleaning', 'legal', 'finance', or 'consulting', find the specific RM.\n"
+        "4. Return UNKNOWN if the query is purely social or unrelated to procurement."
+    )
+
+
+class RmLabeller:
+    """ Long-lived RM labeller, build it once at startup and reuse it for every turn
+
+    The system prompt (instructions + framework directory) is built once, so every
+    request starts with a byte-identical prefix and only the user's query changes.
+    That lets the provider serve the directory from its prompt cache; the cache key
+    is tied to a hash of the directory so a rebuild starts a fresh cache entry.
+    """
+
+    def __init__(self, model, rm_descriptions):
+        """
+        :param model: LLM model to label conversation based on RM
+        :param rm_descriptions(str): all the RM labels and their descriptions
+        """
+        self.model = model
+        self.rm_descriptions = None
+        self.directory_hash = None
+        self.agent = None
+        self.rebuild(rm_descriptions)
+
+    def rebuild(self, rm_descriptions):
+        """ Rebuild the agent for a new framework directory, a no-op if it has not changed
+
+        :param rm_descriptions(str): all the RM labels and their descriptions
+        :return(bool): True if the agent was rebuilt
+        """
+        directory_hash = hashlib.sha256(rm_descriptions.encode("utf-8")).hexdigest()[:16]
+        if directory_hash == self.directory_hash:
+            return False
+        self.agent = Agent(
+            model=self.model,
+            output_type=DataFilterer,
+            model_settings=OpenAIChatModelSettings(
+                temperature=0.0,
+                openai_prompt_cache_key=f"rm-labeller-{directory_hash}",
+            ),
+            system_prompt=labeller_system_prompt(rm_descriptions),
+        )
+        self.rm_descriptions = rm_descriptions
+        self.directory_hash = directory_hash
+        return True
+
+    def rebuild_from_frameworks(self, ccs_frameworks):
+        """ Rebuild from a fresh fetch_all_ccs_frameworks DataFrame
+
+        :param ccs_frameworks(pd.DataFrame): frameworks from fetch_all_ccs_frameworks
+        :return(bool): True if the directory changed and the agent was rebuilt
+        """
+        return self.rebuild(build_rm_descriptions(ccs_frameworks))
+
+    async def run(self, user_input):
+        """ Label a query with an RM number
+
+        :param user_input(str): user's query
+        :return(DataFilterer): RM number and reasoning
+        """
+        result = await self.agent.run(user_input)
+        return result.output
+
+
 async def run_rm_labeller(model, rm_descriptions, user_input):
-    """ Use this function, it labels a conversation based on the RM description
+    """ Use this function, it labels a conversation based on the RM description.
+    It builds a new agent on every call, long running services should use RmLabeller instead
 
     :param model: LLM model to label conversation based on RM
     :param rm_descriptions: user's query
@@ -17,16 +109,7 @@ async def run_rm_labeller(model, rm_descriptions, user_input):
         model=model,
         output_type= DataFilterer,
         model_settings=ModelSettings(temperature=0.0),
-        system_prompt=(
-            "You are a Senior Procurement Analyst. You are an expert across 200 government frameworks. "
-            "Your task is to map any user query—no matter how technical or niche—to the correct RM number. "
-            f"\n\n### MASTER FRAMEWORK DIRECTORY:\n{rm_descriptions}\n\n"
-            "### INSTRUCTIONS:\n"
-            "1. Identify the core industry or service in the query.\n"
-            "2. Match it to the most relevant RM description from the directory.\n"
-            "3. If the user mentions 'cleaning', 'legal', 'finance', or 'consulting', find the specific RM.\n"
-            "4. Return UNKNOWN if the query is purely social or unrelated to procurement."
-        )
+        system_prompt=labeller_system_prompt(rm_descriptions)
 
     )
     result = await rm_labeller.run(user_input)
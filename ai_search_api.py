@@ -2,77 +2,247 @@ from langchain_openai import AzureOpenAIEmbeddings
 from dotenv import load_dotenv
 import os
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorizedQuery
-from fastapi import  FastAPI
-from reranker import rerank_list
+from contextlib import asynccontextmanager
+import asyncio
+from fastapi import  FastAPI, Request
+from reranker import arerank_with_status
+from src.embedding_cache import CachedEmbeddings, normalise_query
+from src.hybrid_search import navigational_rm_numbers, reciprocal_rank_fusion, unique_by_title
+from src.index_generation import read_index_generation
+from src.local_vector_index import LocalVectorIndex
+from src.ttl_cache import TTLCache
 from pydantic import BaseModel
+from typing import Literal, Optional
 
 load_dotenv()
 
+# Concurrency model
+# Every handler is async and runs on the worker's event loop. Nothing on the request
+# path blocks a thread: the query embedding, the vector search and the rerank LLM calls
+# are all awaited, so one worker process can keep hundreds of searches in flight instead
+# of being capped by the threadpool size. Network clients are created once per worker at
+# startup (see lifespan) and their connection pools are shared by every request. The
+# embedding and result caches are in-process and only hold their locks for dict operations.
+
 embed = AzureOpenAIEmbeddings(
     model= os.getenv("EMBEDDING_MODEL_NAME"),
     api_key= os.getenv("AZURE_OPENAI_KEY"),
     azure_endpoint= os.getenv("EMBEDDING_ENDPOINT"),
     api_version= os.getenv("AZURE_OPENAI_API_VERSION")
 )
+# repeat queries are served from memory (or EMBEDDING_CACHE_PATH on disk) instead of re-embedding
+cached_embed = CachedEmbeddings(
+    embed,
+    model_name=os.getenv("EMBEDDING_MODEL_NAME"),
+    disk_path=os.getenv("EMBEDDING_CACHE_PATH")
+)
 
-client = SearchClient(
-    endpoint=os.getenv("SEARCH_ENDPOINT"),
-    index_name=os.getenv("SEARCH_INDEX"),
-    credential=AzureKeyCredential(os.getenv("ADMIN_KEY"))
+# final reranked lists, keyed on the index generation so a re-run of the ingestion script invalidates them
+result_cache = TTLCache(
+    maxsize=int(os.getenv("RESULT_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("RESULT_CACHE_TTL_SECONDS", "3600"))
 )
 
-app = FastAPI()
+SELECT_FIELDS = ["id", "title", "rm_number", "description", "status"]
+# "hybrid" fuses keyword and vector search, "vector" is the original embedding only search
+RETRIEVAL_MODES = ("hybrid", "vector")
+DEFAULT_RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+if DEFAULT_RETRIEVAL_MODE not in RETRIEVAL_MODES:
+    # fail at startup rather than with a KeyError on every request
+    raise ValueError(f"RETRIEVAL_MODE must be one of {', '.join(RETRIEVAL_MODES)}, got {DEFAULT_RETRIEVAL_MODE!r}")
+# chunks fetched per leg in the first round, as a multiple of the unique frameworks asked for
+FETCH_MULTIPLIER = int(os.getenv("FETCH_MULTIPLIER", "2"))
+# upper bound on chunks fetched per leg when frameworks have so many chunks that titles keep repeating
+MAX_FETCH = int(os.getenv("MAX_FETCH", "200"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+retrieval_counts = {"rm_fast_path": 0, **{mode: 0 for mode in RETRIEVAL_MODES}, "extra_fetch_rounds": 0, "rerank_degraded": 0}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """ Open the async search client at startup and close its connections at shutdown
+
+    With LOCAL_INDEX_PATH set, searches run against an in-process index saved by
+    `embed_for_simple_ai_search.py --local-index` instead of Azure AI Search.
+    """
+    local_index_path = os.getenv("LOCAL_INDEX_PATH")
+    if local_index_path:
+        app.state.search_client = LocalVectorIndex.load(local_index_path)
+        print(f"Searching the local index at {local_index_path} ({len(app.state.search_client)} chunks)")
+    else:
+        app.state.search_client = SearchClient(
+            endpoint=os.getenv("SEARCH_ENDPOINT"),
+            index_name=os.getenv("SEARCH_INDEX"),
+            credential=AzureKeyCredential(os.getenv("ADMIN_KEY"))
+        )
+    yield
+    await app.state.search_client.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 class SearchQuery(BaseModel):
     query: str
     total_results: int
     status: str
-
-
+    rerank_mode: Literal["pointwise", "listwise", "lexical"] = "pointwise"
+    retrieval_mode: Optional[Literal["hybrid", "vector"]] = None
+
+
+async def collect(search_client, **search_kwargs):
+    """ Run one search and read every result page
+
+    :return(list): search results, best first
+    """
+    results = await search_client.search(select=SELECT_FIELDS, **search_kwargs)
+    return [res async for res in results]
+
+
+def keyword_leg(search_client, query_text, filter_expr):
+    """ Keyword search as a fetch(skip, top) function for fetch_unique_titles """
+    async def fetch(skip, top):
+        return await collect(search_client, search_text=query_text, filter=filter_expr, skip=skip, top=top)
+    return fetch
+
+
+def vector_leg(search_client, query_vector, filter_expr):
+    """ Vector search as a fetch(skip, top) function for fetch_unique_titles
+
+    k_nearest_neighbors covers everything fetched so far and skip pages past it, so a
+    later round only transfers the chunks the earlier rounds did not.
+    """
+    async def fetch(skip, top):
+        vector_query = VectorizedQuery(vector=query_vector, k_nearest_neighbors=skip + top, fields="embedding")
+        return await collect(
+            search_client, search_text=None, vector_queries=[vector_query], filter=filter_expr, skip=skip, top=top
+        )
+    return fetch
+
+
+async def fetch_unique_titles(legs, total_results, multiplier=FETCH_MULTIPLIER, max_fetch=MAX_FETCH):
+    """ Best chunk of each of the top total_results frameworks, fetching more chunks only when needed
+
+    Each leg first fetches total_results * multiplier chunks. If the chunks do not cover
+    enough distinct titles the window doubles, and only the new slice is fetched, until
+    there are enough titles, every leg has run out of results or max_fetch is reached.
+    With more than one leg the ranked lists are merged with reciprocal rank fusion.
+
+    :param legs(list): fetch(skip, top) coroutine functions, e.g. keyword_leg and vector_leg
+    :param total_results(int): number of distinct frameworks wanted
+    :param multiplier(int): chunks fetched per wanted framework in the first round
+    :param max_fetch(int): maximum chunks fetched per leg
+    :return(list): at most total_results results with distinct titles, best first
+    """
+    window = min(max(1, total_results * multiplier), max_fetch)
+    ranked = [[] for _ in legs]
+    fetched = 0
+    while True:
+        pages = await asyncio.gather(*(fetch(fetched, window - fetched) for fetch in legs))
+        exhausted = all(len(page) < window - fetched for page in pages)
+        for results, page in zip(ranked, pages):
+            results.extend(page)
+        fetched = window
+
+        merged = ranked[0] if len(ranked) == 1 else reciprocal_rank_fusion(ranked, key="id", k=RRF_K)
+        top_results = unique_by_title(merged, total_results)
+        if len(top_results) == total_results or exhausted or window >= max_fetch:
+            return top_results
+        window = min(window * 2, max_fetch)
+        retrieval_counts["extra_fetch_rounds"] += 1
+
+
+async def rm_lookup(search_client, rm_numbers, filter_expr, total_results):
+    """ Frameworks for the RM numbers of a navigational query, in the order they were typed
+
+    :param search_client(SearchClient): async search client
+    :param rm_numbers(list): candidate spellings per RM, from navigational_rm_numbers
+    :param filter_expr(str): status filter, None for no filter
+    :param total_results(int): maximum number of frameworks to return
+    :return(list): one result per framework found
+    """
+    spellings = [spelling for candidates in rm_numbers for spelling in candidates]
+    rm_filter = f"search.in(rm_number, '{','.join(spellings)}', ',')"
+    results = await collect(
+        search_client,
+        search_text="*",
+        filter=f"{rm_filter} and {filter_expr}" if filter_expr else rm_filter,
+        # a handful of chunks per framework is plenty to find each title once
+        top=10 * len(spellings),
+    )
+    position = {spelling: index for index, candidates in enumerate(rm_numbers) for spelling in candidates}
+    results.sort(key=lambda res: position.get(res["rm_number"], len(rm_numbers)))
+    return unique_by_title(results, total_results)
 
 
 @app.post("/results")
-def ai_search_api(query: SearchQuery):
-
-    query_vector = embed.embed_query(query.query.upper())
-    vector_query = VectorizedQuery(
-        vector=query_vector,
-        k_nearest_neighbors=40,  # Increase search window to find enough unique matches
-        fields="embedding"
+async def ai_search_api(query: SearchQuery, request: Request):
+
+    retrieval_mode = query.retrieval_mode or DEFAULT_RETRIEVAL_MODE
+    cache_key = (
+        read_index_generation(),
+        normalise_query(query.query),
+        query.status,
+        query.total_results,
+        query.rerank_mode,
+        retrieval_mode,
     )
+    cached_results = result_cache.get(cache_key)
+    if cached_results is not None:
+        return cached_results
+
     filter_expr = f"status eq '{query.status}'" if query.status else None
-    results = client.search(
-        search_text=None,
-        vector_queries=[vector_query],
-        filter=filter_expr,
-        select=["title", "rm_number", "description", "status"],
-        top=40
+    search_client = request.app.state.search_client
+
+    rm_numbers = navigational_rm_numbers(query.query)
+    if rm_numbers:
+        # the user typed the framework they want, look it up by RM without embedding or reranking
+        top_results = await rm_lookup(search_client, rm_numbers, filter_expr, query.total_results)
+        if top_results:
+            retrieval_counts["rm_fast_path"] += 1
+            result_cache.set(cache_key, top_results)
+            return top_results
+
+    retrieval_counts[retrieval_mode] += 1
+    query_vector = await cached_embed.aembed_query(query.query.upper())
+    legs = [vector_leg(search_client, query_vector, filter_expr)]
+    if retrieval_mode == "hybrid":
+        # exact terms (supplier names, product phrases) are found by the keyword leg even when their embedding is not close
+        legs.append(keyword_leg(search_client, query.query, filter_expr))
+
+    top_results = await fetch_unique_titles(legs, query.total_results)
+    new_results, rerank_complete = await arerank_with_status(
+        user_query=query.query, results=top_results, mode=query.rerank_mode
     )
-
-    top_results = []
-    seen_titles = set()
-
-    for res in results:
-        title = res['title']
-
-        # Check if we've already added this framework title
-        if title not in seen_titles:
-            top_results.append(res)
-            seen_titles.add(title)
-
-        # Stop exactly once we have 10 unique documents
-        if len(top_results) == query.total_results:
-            break
-    new_results = rerank_list(user_query=query.query, results=top_results)
     full_result =""
     for i, res in enumerate(new_results):
         # res['@search.score'] will be based on the best chunk found for that title
         print(f"{i + 1:<5} | {res['title'][:38]:<40} | {res['@search.score']:.4f}")
         full_result += f"\n {i + 1:<5} | {res['title']}"
 
+    if rerank_complete:
+        result_cache.set(cache_key, new_results)
+    else:
+        # a timed out or failed rerank kept vector order, do not serve that for the whole cache TTL
+        retrieval_counts["rerank_degraded"] += 1
     return new_results
 
+
+@app.get("/stats")
+async def stats():
+    """ Cache metrics for the search API
+
+    :return dictionary: embedding and result cache hit/miss counters and searches per retrieval path
+    """
+    return {
+        "index_generation": read_index_generation(),
+        "embedding_cache": cached_embed.stats(),
+        "result_cache": result_cache.stats(),
+        "retrieval": dict(retrieval_counts),
+    }
+
 #uvicorn ai_search_api:app --reload --host 127.0.0.1 --port 5000
 # curl -X POST "http://127.0.0.1:5000/results"      -H "Content-Type: application/json"      -d '{"query": "AI", "total_results": 10, "status": "expired"}'
+# curl -X POST "http://127.0.0.1:5000/results"      -H "Content-Type: application/json"      -d '{"query": "AI", "total_results": 10, "status": "expired", "rerank_mode": "listwise"}'
@@ -1,15 +1,26 @@
 
 import os
+import secrets
+import asyncio
+import json
 
 os.environ["AZURESEARCH_FIELDS_CONTENT_VECTOR"] = "text_vector"
 os.environ["AZURESEARCH_FIELDS_CONTENT"] = "chunk"
 from dotenv import load_dotenv
 from langchain_community.vectorstores.azuresearch import AzureSearch
 from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
-from src.multiturn_utils import build_graph, answer_once
+from src.multiturn_utils import aanswer_once, aanswer_once_speculative, astream_answer_events
+from src.embedding_cache import CachedEmbeddings
+from src.graph_registry import GraphRegistry
+from src.rm_router import RmRouter
+from src.retrieval_cache import RetrievalCache
+from src.write_behind_checkpointer import WriteBehindSaver
+from src.local_vector_index import LocalVectorIndex, LocalVectorStore
 from langgraph_checkpoint_cosmosdb import CosmosDBSaver
+from langgraph.checkpoint.memory import MemorySaver
 
-from fastapi import  FastAPI
+from fastapi import  FastAPI, Depends, Header, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime, timedelta, timezone
@@ -18,28 +29,53 @@ from azure.storage.blob import generate_blob_sas, BlobSasPermissions
 from pydantic_ai.models.openai import OpenAIChatModel
 from pydantic_ai.providers.openai import OpenAIProvider
 from openai import AsyncAzureOpenAI
-from ai_docs_filterer_for_RAG import run_rm_labeller
+from ai_docs_filterer_for_RAG import RmLabeller, build_rm_descriptions
 from ccs_website_data import  fetch_all_ccs_frameworks
 
 
 load_dotenv()
 
 ccs_frameworks = fetch_all_ccs_frameworks()
-graphs = {}
+# start labelling, the first LLM call and retrieval together instead of one after another
+SPECULATIVE_PIPELINE = os.getenv("SPECULATIVE_PIPELINE", "false").lower() == "true"
+# one compiled graph shared by every user, plus per-user turn locks kept while a turn is in flight
+graph_registry = GraphRegistry()
+# previous turns sent to the LLM verbatim, older ones are folded into a rolling summary
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "6"))
+HISTORY_SUMMARY_BATCH_TURNS = int(os.getenv("HISTORY_SUMMARY_BATCH_TURNS", "4"))
 embeddings: AzureOpenAIEmbeddings = AzureOpenAIEmbeddings(
     azure_deployment=os.getenv("EMBEDDING_MODEL_NAME"),
     api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
     azure_endpoint=os.getenv("EMBEDDING_ENDPOINT"),
     api_key=os.getenv("AZURE_OPENAI_KEY"),
 )
+# shares EMBEDDING_CACHE_PATH with the search API so both reuse each other's query embeddings
+cached_embeddings = CachedEmbeddings(
+    embeddings,
+    model_name=os.getenv("EMBEDDING_MODEL_NAME"),
+    disk_path=os.getenv("EMBEDDING_CACHE_PATH")
+)
 
 # Configure Vector Store
-vector_store: AzureSearch = AzureSearch(
-    azure_search_endpoint=os.getenv("VECTOR_STORE_ENDPOINT"),
-    azure_search_key=os.getenv("VECTOR_STORE_KEY"),
-    index_name=os.getenv("VECTOR_STORE_INDEX"),
-    embedding_function=embeddings.embed_query,
-    content_key="chunk")
+if os.getenv("LOCAL_INDEX_PATH"):
+    # offline runs and load tests search an index saved by embed_for_simple_ai_search.py --local-index
+    vector_store = LocalVectorStore(LocalVectorIndex.load(os.getenv("LOCAL_INDEX_PATH")), cached_embeddings)
+else:
+    vector_store: AzureSearch = AzureSearch(
+        azure_search_endpoint=os.getenv("VECTOR_STORE_ENDPOINT"),
+        azure_search_key=os.getenv("VECTOR_STORE_KEY"),
+        index_name=os.getenv("VECTOR_STORE_INDEX"),
+        embedding_function=cached_embeddings,
+        content_key="chunk")
+
+# follow-up questions usually repeat the same RM filter with near identical queries
+retrieval_cache_threshold = os.getenv("RETRIEVAL_CACHE_SIMILARITY_THRESHOLD")
+retrieval_cache = RetrievalCache(
+    maxsize=int(os.getenv("RETRIEVAL_CACHE_SIZE", "2048")),
+    ttl=float(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", "3600")),
+    embeddings=cached_embeddings,
+    similarity_threshold=float(retrieval_cache_threshold) if retrieval_cache_threshold else None,
+)
 
 # Configure LLM
 llm = AzureChatOpenAI(
@@ -64,19 +100,29 @@ pydantic_rm_labeller_model = OpenAIChatModel(
 COSMOS_DB_NAME = os.getenv("COSMOS_DB_NAME")
 COSMOS_CONTAINER_NAME = os.getenv("COSMOS_CONTAINER_NAME")
 
-checkpointer = CosmosDBSaver(
-    database_name=COSMOS_DB_NAME,
-    container_name=COSMOS_CONTAINER_NAME
-)
+# "memory" keeps conversations in process, handy for local runs without Cosmos DB
+if os.getenv("CHECKPOINT_BACKEND", "cosmos").lower() == "memory":
+    checkpoint_backend = MemorySaver()
+else:
+    checkpoint_backend = CosmosDBSaver(
+        database_name=COSMOS_DB_NAME,
+        container_name=COSMOS_CONTAINER_NAME
+    )
+# buffers the checkpoints of a turn and writes them to the backend once, when the turn is flushed
+checkpointer = WriteBehindSaver(checkpoint_backend)
 #This is to be used to help pydantic ai model categorise user's query
-
-rm_descriptions = "\n".join([
-    f"RM: {r.rm_number} | "
-    f"Keywords: {r.keywords if 'keywords' in r and str(r.keywords).strip() else 'N/A'} | "
-    f"Summary: {r.summary} | "
-    f"Pillar: {r.pillar} ({r.category})"
-    for _, r in ccs_frameworks.iterrows()
-])
+# built once so the framework directory is a stable, cacheable prompt prefix
+rm_labeller = RmLabeller(pydantic_rm_labeller_model, build_rm_descriptions(ccs_frameworks))
+# answers obvious queries from framework embeddings and only defers to the LLM labeller when unsure,
+# off unless enabled because its thresholds have to be calibrated against the embedding model in use
+rm_router = None
+if os.getenv("RM_ROUTER_ENABLED", "false").lower() == "true":
+    rm_router = RmRouter(
+        cached_embeddings,
+        ccs_frameworks,
+        min_score=float(os.getenv("RM_ROUTER_MIN_SCORE", "0.8")),
+        min_margin=float(os.getenv("RM_ROUTER_MIN_MARGIN", "0.08")),
+    )
 
 app = FastAPI()
 
@@ -92,28 +138,36 @@ class SearchQuery(BaseModel):
     query:str
 
 
-@app.post("/results")
-async def ai_search_api(query: SearchQuery):
-    """ This function uses a LLM to answer user's query
+async def read_last_rm_label(graph, history_config):
+    """ Label used on the previous turn of a thread, "UNKNOWN" for a new thread
 
-    :param query (Pydantic): data model(class) to answer query per user user
-    :return dictionary: containing AI's response
+    :param graph: compiled LangGraph graph
+    :param history_config(dict): config holding the thread_id
+    :return str: last RM label
     """
+    # every graph/checkpointer call is awaited so one user's turn never blocks the event loop
+    state = await graph.aget_state(history_config)
+    return state.values.get("last_rm_label", "UNKNOWN") if state.values else "UNKNOWN"
 
-    # create langchain graph to orchestrate LLM actions
-    if query.user_id not in graphs:
-        graphs[query.user_id] = build_graph(llm=llm, vector_store=vector_store, checkpointer=checkpointer)
-    graph = graphs[query.user_id]
-    # prepare data to check for a user id what was their last rm number for filtering
-    history_config = {"configurable": {"thread_id": query.user_id}}
-
-    state = graph.get_state(history_config)
 
-    last_known_rm = state.values.get("last_rm_label", "UNKNOWN") if state.values else "UNKNOWN"
+async def pick_rm_label(user_query, last_known_rm):
+    """ Pick the RM label used to filter retrieval for this turn
 
+    :param user_query(str): user's query
+    :param last_known_rm(str): label used on the previous turn of this thread
+    :return str: RM label, or the last known label if the query does not name one
+    """
     # get RM label(e.g RM6200) from user's query if the label returns unknown it means it is likely a follow question
+    rm_label_result = None
+    if rm_router is not None:
+        try:
+            rm_label_result = await rm_router.aroute(user_query)
+        except Exception as e:
+            # the router is only a shortcut, a failure must not skip the labeller
+            print(f"RM router failed, using the labeller: {e!r}")
     try:
-        rm_label_result = await run_rm_labeller(pydantic_rm_labeller_model, rm_descriptions, query.query)
+        if rm_label_result is None:
+            rm_label_result = await rm_labeller.run(user_query)
 
         rm_label = rm_label_result.rm_number
         if rm_label == "UNKNOWN":
@@ -124,13 +178,56 @@ async def ai_search_api(query: SearchQuery):
     except Exception as e:
         print(f"Labelling failed: {e}")
         rm_label = last_known_rm
-    # Keep the last rm label updated
-    graph.update_state(history_config, {"last_rm_label": rm_label})
+    return rm_label
 
 
+@app.post("/results")
+async def ai_search_api(query: SearchQuery):
+    """ This function uses a LLM to answer user's query
 
-    config = {"configurable": {"thread_id": query.user_id, "rm_filter": rm_label}}
-    response = answer_once(graph=graph, user_input=query.query,config=config,thread_id=query.user_id)
+    :param query (Pydantic): data model(class) to answer query per user user
+    :return dictionary: containing AI's response
+    """
+
+    # the compiled graph is shared by every user, the thread_id in the config keeps their histories apart
+    graph = graph_registry.get_graph(
+        llm=llm,
+        vector_store=vector_store,
+        checkpointer=checkpointer,
+        retrieval_cache=retrieval_cache,
+        history_turns=HISTORY_TURNS,
+        summary_batch_turns=HISTORY_SUMMARY_BATCH_TURNS,
+    )
+
+    # turns of the same user run one at a time so their checkpoint writes cannot interleave
+    async with graph_registry.thread_lock(query.user_id):
+        try:
+            # prepare data to check for a user id what was their last rm number for filtering
+            history_config = {"configurable": {"thread_id": query.user_id}}
+            last_known_rm = await read_last_rm_label(graph, history_config)
+
+            if SPECULATIVE_PIPELINE:
+                response, rm_label = await aanswer_once_speculative(
+                    graph=graph,
+                    vector_store=vector_store,
+                    user_input=query.query,
+                    rm_label=pick_rm_label(query.query, last_known_rm),
+                    candidate_rm_labels=[last_known_rm, "UNKNOWN"],
+                    thread_id=query.user_id,
+                    config={"configurable": {"thread_id": query.user_id}},
+                )
+                # Keep the last rm label updated
+                await graph.aupdate_state(history_config, {"last_rm_label": rm_label})
+            else:
+                rm_label = await pick_rm_label(query.query, last_known_rm)
+                # Keep the last rm label updated
+                await graph.aupdate_state(history_config, {"last_rm_label": rm_label})
+
+                config = {"configurable": {"thread_id": query.user_id, "rm_filter": rm_label}}
+                response = await aanswer_once(graph=graph, user_input=query.query,config=config,thread_id=query.user_id)
+        finally:
+            # one checkpoint write for the whole turn
+            await checkpointer.aflush(query.user_id)
     print(f"user: {query.query}")
     print()
     print(f"AI: {response["answer"]}")
@@ -141,6 +238,119 @@ async def ai_search_api(query: SearchQuery):
     return {"AI_response":response["answer"], "source_content":sources}
 
 
+def sse_event(event, data):
+    """ Format one Server-Sent Event with a JSON payload """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/results/stream")
+async def ai_search_stream(query: SearchQuery):
+    """ Same as /results but streams the turn as Server-Sent Events
+
+    Events are sent in this order: "rm_label" once the RM filter is chosen, "sources"
+    when the retrieval returns, "token" for every piece of the answer as it is generated
+    and "done" with the full answer and sources (same shape as /results).
+
+    :param query (Pydantic): data model(class) to answer query per user user
+    :return StreamingResponse: text/event-stream
+    """
+    graph = graph_registry.get_graph(
+        llm=llm,
+        vector_store=vector_store,
+        checkpointer=checkpointer,
+        retrieval_cache=retrieval_cache,
+        history_turns=HISTORY_TURNS,
+        summary_batch_turns=HISTORY_SUMMARY_BATCH_TURNS,
+    )
+
+    async def event_stream():
+        async with graph_registry.thread_lock(query.user_id):
+            try:
+                history_config = {"configurable": {"thread_id": query.user_id}}
+                last_known_rm = await read_last_rm_label(graph, history_config)
+                rm_label = await pick_rm_label(query.query, last_known_rm)
+                await graph.aupdate_state(history_config, {"last_rm_label": rm_label})
+                yield sse_event("rm_label", {"rm_label": rm_label})
+
+                config = {"configurable": {"thread_id": query.user_id, "rm_filter": rm_label}}
+                async for event, data in astream_answer_events(graph, query.query, config):
+                    if event == "sources":
+                        yield sse_event("sources", {"source_content": list(dict.fromkeys(data))})
+                    elif event == "token":
+                        yield sse_event("token", {"token": data})
+                    else:
+                        yield sse_event("done", {
+                            "AI_response": data["answer"],
+                            "source_content": list(dict.fromkeys(data["source_names"])),
+                        })
+            except Exception as e:
+                print(f"Streaming turn failed: {e}")
+                yield sse_event("error", {"detail": "Error generating the answer."})
+            finally:
+                await checkpointer.aflush(query.user_id)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # stop proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def require_admin_key(x_admin_key: str | None = Header(None)):
+    """ Only let maintenance endpoints run with the CHATBOT_ADMIN_KEY header, they are disabled without it
+
+    The API is CORS open, so anything that scrapes, re-embeds or drops caches must not be callable by any browser.
+    """
+    admin_key = os.getenv("CHATBOT_ADMIN_KEY")
+    if not admin_key:
+        raise HTTPException(status_code=403, detail="Maintenance endpoints are disabled, set CHATBOT_ADMIN_KEY")
+    if not x_admin_key or not secrets.compare_digest(x_admin_key, admin_key):
+        raise HTTPException(status_code=403, detail="Invalid admin key")
+
+
+@app.post("/refresh_frameworks", dependencies=[Depends(require_admin_key)])
+async def refresh_frameworks():
+    """ Re-fetch the CCS frameworks and rebuild the RM labeller and router if the directory changed
+
+    :return dictionary: whether the labeller was rebuilt and the directory hash in use
+    """
+    global ccs_frameworks
+    frameworks = await asyncio.to_thread(fetch_all_ccs_frameworks)
+    if frameworks is None:
+        return {"rebuilt": False, "directory_hash": rm_labeller.directory_hash}
+    ccs_frameworks = frameworks
+    rebuilt = rm_labeller.rebuild_from_frameworks(ccs_frameworks)
+    if rebuilt and rm_router is not None:
+        await asyncio.to_thread(rm_router.rebuild, ccs_frameworks)
+    return {"rebuilt": rebuilt, "directory_hash": rm_labeller.directory_hash}
+
+
+@app.post("/invalidate_retrieval_cache", dependencies=[Depends(require_admin_key)])
+async def invalidate_retrieval_cache(rm_number: str | None = None):
+    """ Drop cached retrievals, e.g. after the documents of an RM were re-indexed
+
+    :param rm_number(str): RM whose retrievals should be dropped, all of them if not given
+    :return dictionary: number of cached retrievals dropped
+    """
+    return {"dropped": retrieval_cache.invalidate(rm_number)}
+
+
+@app.get("/stats")
+async def stats():
+    """ Cache and registry metrics for the chatbot
+
+    :return dictionary: graph registry sizes, cache counters and RM router short circuit rate
+    """
+    return {
+        "graph_registry": graph_registry.stats(),
+        "embedding_cache": cached_embeddings.stats(),
+        "rm_router": rm_router.stats() if rm_router is not None else None,
+        "retrieval_cache": retrieval_cache.stats(),
+        "checkpointer": checkpointer.stats(),
+    }
+
+
 @app.get("/get_download_url/{file_name}")
 async def get_download_url(file_name: str):
     """ Downloads files from storage that has been retrieved by LLM
@@ -174,4 +384,5 @@ async def get_download_url(file_name: str):
     return {"download_url": download_url}
 
 # uvicorn chatbot_api:app --reload --host 127.0.0.1 --port 8000
-#  curl -X POST "http://127.0.0.1:8000/results"      -H "Content-Type: application/json"      -d '{"user_id": "abc","query": "what is  1+1"}'
\ No newline at end of file
+#  curl -X POST "http://127.0.0.1:8000/results"      -H "Content-Type: application/json"      -d '{"user_id": "abc","query": "what is  1+1"}'
+#  curl -N -X POST "http://127.0.0.1:8000/results/stream"      -H "Content-Type: application/json"      -d '{"user_id": "abc","query": "what is  1+1"}'
\ No newline at end of file
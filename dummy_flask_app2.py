@@ -1,10 +1,9 @@
 import uuid
 import os
-import csv
-from datetime import datetime
-import ast
-from flask import Flask, render_template, session, request, redirect, url_for
+from flask import Flask, render_template, session, request, redirect, url_for, jsonify, make_response
 from dotenv import load_dotenv
+from src.agreement_store import AgreementStore
+from src.agreement_search import AgreementSearch, FACET_FIELDS
 
 load_dotenv()
 
@@ -17,50 +16,12 @@ app.config.update(
 api_url = os.getenv('WEBSEARCH_API_URL')
 download_url = os.getenv('DOWNLOAD_SOURCE_URL')
 CSV_PATH = os.path.join(os.path.dirname(__file__), "website_agreement_data2.csv")
+RESULTS_PAGE_SIZE = int(os.getenv('RESULTS_PAGE_SIZE', 20))
 
 
-def _format_date(date_str: str) -> str:
-    if not date_str:
-        return ""
-    try:
-        return datetime.strptime(date_str, "%Y-%m-%d").strftime("%d/%m/%Y")
-    except Exception:
-        return date_str
-
-
-def load_agreements():
-    """Load all agreements from the local CSV file (no filtering)."""
-    agreements = []
-    with open(CSV_PATH, "r", encoding="utf-8", newline="") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            lots_raw = row.get("lots") or "[]"
-            lots = []
-            try:
-                parsed = ast.literal_eval(lots_raw)
-                if isinstance(parsed, list):
-                    lots = parsed
-            except Exception:
-                lots = []
-
-            agreements.append(
-                {
-                    "id": row.get("id") or "",
-                    "title": row.get("title") or "",
-                    "rm_number": row.get("rm_number") or "",
-                    "start_date": _format_date(row.get("start_date") or ""),
-                    "end_date": _format_date(row.get("end_date") or ""),
-                    "regulation": row.get("regulation") or "",
-                    "agreement_type": row.get("regulation_type") or "",
-                    "summary": row.get("summary") or "",
-                    "description": row.get("description") or "",
-                    "benefits": row.get("benefits") or "",
-                    "how_to_buy": row.get("how_to_buy") or "",
-                    "lots": lots,
-                    "lots_count": len(lots) if lots else 0,
-                }
-            )
-    return agreements
+agreement_store = AgreementStore(CSV_PATH)
+agreement_search = AgreementSearch(agreement_store)
+
 
 @app.route('/', methods=['GET', 'POST'])
 def login():
@@ -97,15 +58,34 @@ def results():
     if 'user_id' not in session:
         session['user_id'] = str(uuid.uuid4())
 
-    # Note: we intentionally ignore query filtering for now and render all CSV results.
-    agreements = load_agreements()
-    return render_template(
+    query = request.args.get('q', '').strip()
+    filters = {field: [v for v in request.args.getlist(field) if v] for field in FACET_FIELDS}
+    page = request.args.get('page', 1, type=int)
+    search = agreement_search.search(query, filters, page=page, page_size=RESULTS_PAGE_SIZE)
+
+    response = make_response(render_template(
         'results.html',
         user_id=session['user_id'],
         api_url=api_url,
         download_url=download_url,
-        agreements=agreements,
-    )
+        agreements=search["agreements"],
+        search=search,
+        query=query,
+        filters=filters,
+        # selected filters only, carried through the pagination links
+        filter_args={field: values for field, values in filters.items() if values},
+        # agreements still being developed, what the "Upcoming agreements" link filters on
+        upcoming_statuses=[status for status in search["facets"]["status"] if status.endswith("(Pipeline)")],
+    ))
+    response.headers['Server-Timing'] = f'search;dur={search["took_ms"]:.2f}'
+    return response
+
+
+@app.route('/search_stats')
+def search_stats():
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    return jsonify(agreement_search.stats())
 
 
 @app.route('/agreement/<rm_number>')
@@ -113,8 +93,7 @@ def agreement(rm_number: str):
     if not session.get('logged_in'):
         return redirect(url_for('login'))
 
-    agreements = load_agreements()
-    selected = next((a for a in agreements if a.get("rm_number") == rm_number), None)
+    selected = agreement_store.by_rm_number(rm_number)
     if not selected:
         return redirect(url_for('results'))
 
@@ -1,48 +1,110 @@
 from ccs_website_data import  fetch_all_ccs_frameworks
 from langchain_openai import AzureOpenAIEmbeddings
 import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import tiktoken
+from openai import RateLimitError
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 import hashlib
+from src.index_generation import bump_index_generation
+from src.local_vector_index import LocalVectorIndex
 from dotenv import load_dotenv
 
 load_dotenv()
 
-ccs_frameworks = fetch_all_ccs_frameworks()
-
-embed = AzureOpenAIEmbeddings(
-    model= os.getenv("EMBEDDING_MODEL_NAME"),
-    api_key= os.getenv("AZURE_OPENAI_KEY"),
-    azure_endpoint= os.getenv("EMBEDDING_ENDPOINT"),
-    api_version= os.getenv("AZURE_OPENAI_API_VERSION")
+# chunk id -> hashes of what was last uploaded for it, lets incremental runs skip unchanged chunks
+MANIFEST_PATH = os.getenv(
+    "INGEST_MANIFEST_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "ingest_manifest.json")
 )
+# embedding requests are sized by tokens, the API also caps the number of inputs per request
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "20000"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "8"))
+# Azure AI Search accepts up to 1000 documents (16 MB) per indexing request, vectors make ours large
+UPLOAD_BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", "500"))
+CHUNK_SIZE = 600
+CHUNK_OVERLAP = 100
+# fields copied from the framework onto every chunk, changes to them do not need a new embedding
+METADATA_FIELDS = ["rm_number", "status", "summary", "start_date", "regulation"]
+
+
+def create_clients(local_index_path=None):
+    """ Embedding model and search client configured from the environment
+
+    :param local_index_path(str): fill the local index saved in this directory instead of Azure AI Search
+    :return(tuple): AzureOpenAIEmbeddings, SearchClient or LocalVectorIndex
+    """
+    embed = AzureOpenAIEmbeddings(
+        model= os.getenv("EMBEDDING_MODEL_NAME"),
+        api_key= os.getenv("AZURE_OPENAI_KEY"),
+        azure_endpoint= os.getenv("EMBEDDING_ENDPOINT"),
+        api_version= os.getenv("AZURE_OPENAI_API_VERSION")
+    )
+    if local_index_path:
+        return embed, LocalVectorIndex.load_or_create(local_index_path)
+    client = SearchClient(
+        endpoint=os.getenv("SEARCH_ENDPOINT"),
+        index_name=os.getenv("SEARCH_INDEX"),
+        credential=AzureKeyCredential(os.getenv("ADMIN_KEY"))
+    )
+    return embed, client
+
+
+def content_hash(value):
+    return hashlib.md5(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
 
-client = SearchClient(
-    endpoint=os.getenv("SEARCH_ENDPOINT"),
-    index_name=os.getenv("SEARCH_INDEX"),
-    credential=AzureKeyCredential(os.getenv("ADMIN_KEY"))
-)
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=600,
-    chunk_overlap=100
-)
 
+_encoding = None
 
-# loop over title
-for index, row in ccs_frameworks.iterrows():
+
+def count_tokens(text):
+    """ Number of tokens in text for the embedding model, roughly 4 characters per token if tiktoken has no encoding """
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"tiktoken encoding unavailable, estimating token counts: {e!r}")
+            _encoding = False
+    if _encoding is False:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+_text_splitter = None
+
+
+def chunk_framework(row):
+    """ Split one framework description into index documents, runs in the chunking process pool
+
+    :param row(dict): framework from fetch_all_ccs_frameworks
+    :return(list): (document without embedding, text to embed, token count) per chunk
+    """
+    global _text_splitter
+    if _text_splitter is None:
+        _text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP
+        )
     title = row['title']
     # text split description
     description = row['description']
+    chunks = []
     #  use text splitter
-    chunks = text_splitter.split_text(description)
-    all_docs = []
-    for index, chunk in enumerate(chunks):
+    for chunk in _text_splitter.split_text(description):
         id_string = title + chunk
         unique_id = hashlib.md5(id_string.encode("utf-8")).hexdigest()
         # this appends title to each chunk
         enriched_data = f"Title: {title}\nDescription chunk: {chunk}"
-        embedded_chunk = embed.embed_query(enriched_data)
         docs =  {
             "id": unique_id,
             "title": title,
@@ -52,13 +114,355 @@ for index, row in ccs_frameworks.iterrows():
             "summary": row["summary"],
             "start_date": str(row['start_date']),
             "regulation": row["regulation"],
-            "embedding": embedded_chunk
         }
+        chunks.append((docs, enriched_data, count_tokens(enriched_data)))
+    return chunks
+
+
+def chunk_hashes(doc, enriched_data):
+    """ Hash of the embedded text and hash of the metadata fields of a chunk """
+    return {
+        "content": content_hash(enriched_data),
+        "metadata": content_hash({field: doc[field] for field in METADATA_FIELDS}),
+    }
+
+
+def load_manifest(path=MANIFEST_PATH):
+    """ Chunk id -> hashes recorded by the last run, empty if there was none """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest, path=MANIFEST_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def classify_chunk(previous, hashes):
+    """ What an incremental run has to do with a chunk
+
+    :param previous(dict): hashes the manifest holds for the chunk id, None if it is new
+    :param hashes(dict): hashes of the chunk now
+    :return(str): "embed" for new or changed text, "merge" when only its metadata changed, otherwise "unchanged"
+    """
+    if previous is None or previous["content"] != hashes["content"]:
+        return "embed"
+    if previous["metadata"] != hashes["metadata"]:
+        return "merge"
+    return "unchanged"
+
+
+class TokenBatcher:
+    """ Groups chunks from any number of frameworks into embedding requests
+
+    A request is closed when the next chunk would take it over max_tokens or it holds
+    max_inputs texts; a single chunk larger than the budget gets a request of its own.
+    """
+
+    def __init__(self, max_tokens=EMBED_BATCH_TOKENS, max_inputs=EMBED_BATCH_SIZE):
+        self.max_tokens = max_tokens
+        self.max_inputs = max_inputs
+        self.batch = []
+        self.tokens = 0
+
+    def add(self, doc, enriched_data, tokens):
+        """ Add a chunk, returns the batch it closed or None """
+        closed = None
+        if self.batch and (self.tokens + tokens > self.max_tokens or len(self.batch) >= self.max_inputs):
+            closed = self.flush()
+        self.batch.append((doc, enriched_data))
+        self.tokens += tokens
+        return closed
+
+    def flush(self):
+        """ Close the current batch, None if it is empty """
+        batch = self.batch or None
+        self.batch, self.tokens = [], 0
+        return batch
+
+
+def retry_delay(error, attempt):
+    """ Seconds to wait before retrying a rate limited request, the Retry-After header if the API sent one """
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        # exponential backoff with jitter, capped at a minute
+        return min(60, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+async def aembed_batch(embed, texts, max_retries=EMBED_MAX_RETRIES):
+    """ Embed a batch of texts in one request, backing off and retrying the batch when rate limited
+
+    :param embed: LangChain embeddings
+    :param texts(list): texts to embed
+    :param max_retries(int): retries of this batch before giving up
+    :return(list): one embedding per text
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return await embed.aembed_documents(texts)
+        except RateLimitError as e:
+            if attempt == max_retries:
+                raise
+            delay = retry_delay(e, attempt)
+            print(f"Rate limited embedding {len(texts)} chunks, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+def index_in_batches(client, action, documents, batch_size=UPLOAD_BATCH_SIZE):
+    """ Send documents to the index in large batches and report documents the index rejected
+
+    :param client(SearchClient): search index client
+    :param action(str): "merge_or_upload", "merge" or "delete"
+    :param documents(list): documents (only the id for deletes)
+    :param batch_size(int): documents per indexing request
+    :return(set): ids of the documents that failed
+    """
+    send = getattr(client, f"{action}_documents")
+    failed = set()
+    for start in range(0, len(documents), batch_size):
+        results = send(documents=documents[start:start + batch_size])
+        for result in results or []:
+            if not result.succeeded:
+                failed.add(result.key)
+                print(f"{action} failed for {result.key}: {result.error_message}")
+    return failed
+
+
+async def produce_batches(ccs_frameworks, manifest, embed_queue, run, chunk_workers, batcher, embed_workers):
+    """ Chunking stage: split the frameworks on a process pool and queue the chunks that need embedding
+
+    Chunking runs ahead of the embedders by at most 2 * chunk_workers frameworks and
+    blocks on the bounded embed queue when they fall behind.
+    """
+    loop = asyncio.get_running_loop()
+    # 0 workers chunks on the event loop's default thread pool instead of child processes
+    pool = ProcessPoolExecutor(max_workers=chunk_workers) if chunk_workers > 0 else None
+    pending = deque()
+
+    async def queue_chunks(framework_chunks):
+        for doc, enriched_data, tokens in await framework_chunks:
+            # the id is a hash of title + chunk, a repeated chunk would be the same document
+            if doc["id"] in run["hashes"]:
+                continue
+            hashes = run["hashes"][doc["id"]] = chunk_hashes(doc, enriched_data)
+            action = classify_chunk(manifest.get(doc["id"]), hashes)
+            run["chunks"] += 1
+            if action == "embed":
+                batch = batcher.add(doc, enriched_data, tokens)
+                if batch:
+                    await embed_queue.put(batch)
+            elif action == "merge":
+                run["merge"].append({"id": doc["id"], **{field: doc[field] for field in METADATA_FIELDS}})
+            else:
+                run["unchanged"] += 1
+
+    try:
+        for _, row in ccs_frameworks.iterrows():
+            pending.append(loop.run_in_executor(pool, chunk_framework, row.to_dict()))
+            if len(pending) >= 2 * max(chunk_workers, 1):
+                await queue_chunks(pending.popleft())
+        while pending:
+            await queue_chunks(pending.popleft())
+        batch = batcher.flush()
+        if batch:
+            await embed_queue.put(batch)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    for _ in range(embed_workers):
+        await embed_queue.put(None)
+
+
+async def embed_worker(embed, embed_queue, upload_queue, run, max_retries):
+    """ Embedding stage: one of the embed_concurrency workers, so at most that many requests are in flight """
+    while (batch := await embed_queue.get()) is not None:
+        embeddings = await aembed_batch(embed, [enriched_data for _, enriched_data in batch], max_retries)
+        run["embedded"] += len(batch)
+        await upload_queue.put([{**doc, "embedding": embedding} for (doc, _), embedding in zip(batch, embeddings)])
+
+
+async def upload_worker(client, upload_queue, run, upload_batch_size):
+    """ Upload stage: collects embedded documents into full indexing batches """
+    docs = []
+    while (embedded := await upload_queue.get()) is not None:
+        docs.extend(embedded)
+        while len(docs) >= upload_batch_size:
+            batch, docs = docs[:upload_batch_size], docs[upload_batch_size:]
+            # the search client is blocking, keep it off the event loop
+            run["failed"] |= await asyncio.to_thread(index_in_batches, client, "merge_or_upload", batch, upload_batch_size)
+    if docs:
+        run["failed"] |= await asyncio.to_thread(index_in_batches, client, "merge_or_upload", docs, upload_batch_size)
+
+
+async def arun_ingestion(
+    embed,
+    client,
+    ccs_frameworks,
+    incremental=False,
+    manifest_path=MANIFEST_PATH,
+    allow_mass_delete=False,
+    chunk_workers=os.cpu_count() or 1,
+    embed_concurrency=4,
+    upload_workers=1,
+    queue_size=8,
+    embed_batch_tokens=EMBED_BATCH_TOKENS,
+    embed_batch_size=EMBED_BATCH_SIZE,
+    upload_batch_size=UPLOAD_BATCH_SIZE,
+    max_retries=EMBED_MAX_RETRIES,
+):
+    """ Chunk, embed and upload the frameworks as a staged pipeline
+
+    Chunking (process pool) -> embed queue -> embed workers -> upload queue -> upload
+    workers. Both queues are bounded to queue_size items so a slow stage holds back the
+    ones before it instead of piling chunks up in memory. Incremental runs only embed
+    what changed since the manifest was written and delete chunks that are gone.
+
+    :param embed: LangChain embeddings
+    :param client(SearchClient): search index client
+    :param ccs_frameworks(pd.DataFrame): frameworks from fetch_all_ccs_frameworks
+    :param incremental(bool): skip chunks the manifest says are already in the index and delete orphans
+    :param manifest_path(str): manifest file, rewritten after every run
+    :param allow_mass_delete(bool): delete orphans even when they are more than half of the manifest
+    :param chunk_workers(int): chunking processes, 0 to chunk on threads
+    :param embed_concurrency(int): embedding requests in flight
+    :param upload_workers(int): indexing requests in flight
+    :param queue_size(int): batches each queue holds before the stage feeding it waits
+    :param embed_batch_tokens(int): token budget of an embedding request
+    :param embed_batch_size(int): maximum texts in an embedding request
+    :param upload_batch_size(int): documents per indexing request
+    :param max_retries(int): retries of a rate limited embedding request
+    :return(dict): chunk counts and throughput
+    """
+    start = time.perf_counter()
+    manifest = load_manifest(manifest_path) if incremental else {}
+    run = {"chunks": 0, "embedded": 0, "unchanged": 0, "merge": [], "hashes": {}, "failed": set()}
+    embed_queue = asyncio.Queue(maxsize=queue_size)
+    upload_queue = asyncio.Queue(maxsize=queue_size)
+
+    async with asyncio.TaskGroup() as tasks:
+        tasks.create_task(produce_batches(
+            ccs_frameworks, manifest, embed_queue, run, chunk_workers,
+            TokenBatcher(embed_batch_tokens, embed_batch_size), embed_concurrency,
+        ))
+        embedders = [
+            tasks.create_task(embed_worker(embed, embed_queue, upload_queue, run, max_retries))
+            for _ in range(embed_concurrency)
+        ]
+        uploaders = [
+            tasks.create_task(upload_worker(client, upload_queue, run, upload_batch_size))
+            for _ in range(upload_workers)
+        ]
+
+        async def close_uploads():
+            await asyncio.gather(*embedders)
+            for _ in uploaders:
+                await upload_queue.put(None)
+
+        tasks.create_task(close_uploads())
+
+    failed = run["failed"]
+    failed |= await asyncio.to_thread(index_in_batches, client, "merge", run["merge"], upload_batch_size)
+
+    orphans = [chunk_id for chunk_id in manifest if chunk_id not in run["hashes"]] if incremental else []
+    if orphans and len(orphans) > len(manifest) / 2 and not allow_mass_delete:
+        # most likely a partial fetch of the frameworks rather than half the catalogue disappearing
+        print(f"Not deleting {len(orphans)} of {len(manifest)} indexed chunks, rerun with --allow-mass-delete if that is intended")
+        kept_orphans = {chunk_id: manifest[chunk_id] for chunk_id in orphans}
+        orphans = []
+    else:
+        failed_deletes = await asyncio.to_thread(
+            index_in_batches, client, "delete", [{"id": chunk_id} for chunk_id in orphans], upload_batch_size
+        )
+        # keep orphans that could not be deleted so the next run tries again
+        kept_orphans = {chunk_id: manifest[chunk_id] for chunk_id in failed_deletes}
+        orphans = [chunk_id for chunk_id in orphans if chunk_id not in failed_deletes]
+        failed |= failed_deletes
+
+    # chunks the index rejected are left out of the manifest so the next run uploads them again
+    save_manifest({
+        **kept_orphans,
+        **{chunk_id: hashes for chunk_id, hashes in run["hashes"].items() if chunk_id not in failed},
+    }, manifest_path)
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "chunks": run["chunks"],
+        "embedded": run["embedded"],
+        "metadata_merged": len(run["merge"]),
+        "skipped": run["unchanged"],
+        "deleted": len(orphans),
+        "failed": len(failed),
+        "seconds": round(elapsed, 2),
+        "chunks_per_second": round(run["chunks"] / elapsed, 1) if elapsed else 0.0,
+        "embedded_per_second": round(run["embedded"] / elapsed, 1) if elapsed else 0.0,
+    }
+    print(f"Ingestion summary: {summary}")
+    return summary
 
 
-        all_docs.append(docs)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chunk, embed and upload the CCS frameworks to the search index")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only embed and upload chunks that changed since the last run, and delete removed ones")
+    parser.add_argument("--manifest", default=None,
+                        help="chunk id -> content hash manifest file, defaults to INGEST_MANIFEST_PATH "
+                             "or ingest_manifest.json inside --local-index")
+    parser.add_argument("--allow-mass-delete", action="store_true",
+                        help="delete orphaned chunks even when they are more than half of the index")
+    parser.add_argument("--chunk-workers", type=int, default=os.cpu_count() or 1,
+                        help="processes splitting framework descriptions, 0 to use threads")
+    parser.add_argument("--embed-concurrency", type=int, default=4, help="embedding requests in flight")
+    parser.add_argument("--upload-workers", type=int, default=1, help="indexing requests in flight")
+    parser.add_argument("--queue-size", type=int, default=8, help="batches buffered between two stages")
+    parser.add_argument("--embed-batch-tokens", type=int, default=EMBED_BATCH_TOKENS, help="token budget of an embedding request")
+    parser.add_argument("--embed-batch-size", type=int, default=EMBED_BATCH_SIZE, help="maximum texts in an embedding request")
+    parser.add_argument("--upload-batch-size", type=int, default=UPLOAD_BATCH_SIZE, help="documents per indexing request")
+    parser.add_argument("--local-index", default=None,
+                        help="write the chunks to a local vector index in this directory instead of Azure AI Search")
+    args = parser.parse_args(argv)
+    # the local index has its own contents, so it must not share the Azure index's manifest
+    manifest_path = args.manifest or (
+        os.path.join(args.local_index, "ingest_manifest.json") if args.local_index else MANIFEST_PATH
+    )
 
-    if all_docs:
-        client.upload_documents(documents=all_docs)
+    ccs_frameworks = fetch_all_ccs_frameworks()
+    if ccs_frameworks is None:
+        print("No frameworks fetched, nothing to ingest")
+        return
+    if args.local_index:
+        os.makedirs(args.local_index, exist_ok=True)
+    embed, client = create_clients(args.local_index)
+    summary = asyncio.run(arun_ingestion(
+        embed,
+        client,
+        ccs_frameworks,
+        incremental=args.incremental,
+        manifest_path=manifest_path,
+        allow_mass_delete=args.allow_mass_delete,
+        chunk_workers=args.chunk_workers,
+        embed_concurrency=args.embed_concurrency,
+        upload_workers=args.upload_workers,
+        queue_size=args.queue_size,
+        embed_batch_tokens=args.embed_batch_tokens,
+        embed_batch_size=args.embed_batch_size,
+        upload_batch_size=args.upload_batch_size,
+    ))
+    if args.local_index:
+        # the marker tracks the shared Azure index, a local index is only read when an API starts
+        client.save(args.local_index)
+        print(f"Saved {len(client)} chunks to the local index at {args.local_index}")
+    elif summary["embedded"] or summary["metadata_merged"] or summary["deleted"]:
+        # cached search results are keyed on this, bumping it invalidates them
+        print(f"Index generation bumped to {bump_index_generation()}")
 
 
+if __name__ == "__main__":
+    main()
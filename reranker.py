@@ -1,6 +1,12 @@
 from langchain_openai import  AzureChatOpenAI
 import os
-from system_prompt import system_prompt
+import asyncio
+import csv
+import threading
+import numpy as np
+from pydantic import BaseModel, Field
+from system_prompt import system_prompt, listwise_system_prompt
+from src.bm25 import BM25Index
 from dotenv import load_dotenv
 import os
 
@@ -20,24 +26,206 @@ llm = AzureChatOpenAI(
     max_tokens=1,
 )
 
-def rerank_list(results, user_query):
+# the listwise mode needs room for a full ordering so it cannot share the max_tokens=1 client
+listwise_llm = AzureChatOpenAI(
+    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+    api_key=os.getenv("AZURE_OPENAI_KEY"),
+    azure_deployment=os.getenv("DEPLOYMENT_NAME"),
+    api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+    temperature=0.0,
+    top_p=1,
+    frequency_penalty=0,
+    presence_penalty=0,
+    seed=0,
+)
+
+# how many Yes/No judgements can be in flight at once for a single request
+RERANK_MAX_CONCURRENCY = int(os.getenv("RERANK_MAX_CONCURRENCY", "10"))
+# seconds the whole rerank is allowed to take before we fall back to vector order
+RERANK_DEADLINE_SECONDS = float(os.getenv("RERANK_DEADLINE_SECONDS", "5"))
+# framework catalogue the lexical reranker takes its term statistics from
+LEXICAL_CORPUS_PATH = os.getenv(
+    "LEXICAL_CORPUS_PATH",
+    os.path.join(os.path.dirname(__file__), "website_agreement_data2.csv")
+)
+
+
+async def judge_relevance(result, user_query, semaphore):
+    """ Ask the LLM for a single Yes/No relevance judgement
+
+    :param result(dict): search result containing a title and description
+    :param user_query(str): user's query
+    :param semaphore(asyncio.Semaphore): limits how many LLM calls run at once
+    :return(str): raw LLM answer
     """
-    solution
-    :param results:
-    :return:
+    description = result["description"]
+    full_text = result["title"] + " " + description
+    sys_prompt = system_prompt(user_query, full_text)
+    async with semaphore:
+        response = await llm.ainvoke(sys_prompt)
+    return response.content
+
+
+async def arerank_list(results, user_query,
+                       max_concurrency=RERANK_MAX_CONCURRENCY,
+                       deadline=RERANK_DEADLINE_SECONDS):
+    """ Rerank results by fanning the Yes/No judgements out concurrently
+
+    Results judged "Yes" come first, then any result that was not judged in time
+    (or whose judgement failed), then results judged "No". Each group keeps the
+    vector score order it came in with, so a slow LLM never fails the request.
+
+    :param results(list): search results ordered by vector score
+    :param user_query(str): user's query
+    :param max_concurrency(int): maximum number of LLM calls in flight
+    :param deadline(float): seconds to wait for judgements before giving up on the rest
+    :return(tuple): reranked results, and whether every result was judged
     """
+    if not results:
+        return [], True
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = [asyncio.create_task(judge_relevance(result, user_query, semaphore)) for result in results]
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+    if pending:
+        print(f"Rerank deadline of {deadline}s passed, {len(pending)} results kept in vector order")
+
     good_list = []
+    unjudged_list = []
     bad_list = []
-    for result in results:
-        description = result["description"]
-        full_text = result["title"] + " " + description
-        sys_prompt = system_prompt(user_query, full_text)
-        response = llm.invoke(sys_prompt)
-        if "Yes" in  response.content:
+    for result, task in zip(results, tasks):
+        if task in pending or task.exception() is not None:
+            unjudged_list.append(result)
+        elif "Yes" in task.result():
             good_list.append(result)
+        elif "No" in task.result():
+            bad_list.append(result)
+        else:
+            unjudged_list.append(result)
 
+    return good_list + unjudged_list + bad_list, not unjudged_list
 
-        if "No" in response.content:
-            bad_list.append(result)
 
-    return good_list  + bad_list
+class RerankOrdering(BaseModel):
+    ranking: list[int] = Field(description="Numbers of every agreement, most relevant first.")
+
+
+async def alistwise_rerank_list(results, user_query, deadline=RERANK_DEADLINE_SECONDS):
+    """ Rerank all results with a single LLM call that returns a full ordering
+
+    Numbers the model leaves out, repeats or makes up are ignored, and any result
+    it did not rank is appended in vector score order. If the call fails or misses
+    the deadline the vector score order is returned unchanged.
+
+    :param results(list): search results ordered by vector score
+    :param user_query(str): user's query
+    :param deadline(float): seconds to wait for the ordering
+    :return(tuple): reranked results, and whether the LLM ordering was used
+    """
+    if not results:
+        return [], True
+
+    candidates = [result["title"] + " " + result["description"] for result in results]
+    ranker = listwise_llm.with_structured_output(RerankOrdering)
+    try:
+        ordering = await asyncio.wait_for(
+            ranker.ainvoke(listwise_system_prompt(user_query, candidates)),
+            timeout=deadline
+        )
+    except Exception as e:
+        print(f"Listwise rerank failed, keeping vector order: {e!r}")
+        return list(results), False
+
+    ranked_indices = []
+    for index in ordering.ranking:
+        if 0 <= index < len(results) and index not in ranked_indices:
+            ranked_indices.append(index)
+    ranked_indices += [index for index in range(len(results)) if index not in ranked_indices]
+    return [results[index] for index in ranked_indices], True
+
+
+_lexical_index = None
+_lexical_index_lock = threading.Lock()
+
+
+def get_lexical_index():
+    """ Build the BM25 index over the framework catalogue once and reuse it
+
+    :return(BM25Index): index over title + description of every framework
+    """
+    global _lexical_index
+    if _lexical_index is None:
+        with _lexical_index_lock:
+            if _lexical_index is None:
+                with open(LEXICAL_CORPUS_PATH, "r", encoding="utf-8", newline="") as f:
+                    corpus = [
+                        f"{row.get('title') or ''} {row.get('description') or ''}"
+                        for row in csv.DictReader(f)
+                    ]
+                _lexical_index = BM25Index(corpus)
+    return _lexical_index
+
+
+async def alexical_rerank_list(results, user_query):
+    """ Rerank results in-process with BM25, no LLM round-trip
+
+    All candidates are scored in one vectorised batch against the term statistics
+    of the framework catalogue. Ties keep their vector score order.
+
+    :param results(list): search results ordered by vector score
+    :param user_query(str): user's query
+    :return(tuple): reranked results, and True as local scoring cannot fall back
+    """
+    if not results:
+        return [], True
+
+    texts = [result["title"] + " " + result["description"] for result in results]
+    scores = get_lexical_index().score_texts(user_query, texts)
+    order = np.argsort(-scores, kind="stable")
+    return [results[index] for index in order], True
+
+
+# every backend is an async function taking (results, user_query) and returning the reordered results
+# plus a flag that is False when the backend fell back to (part of) the vector order
+RERANK_MODES = {
+    "pointwise": arerank_list,
+    "listwise": alistwise_rerank_list,
+    "lexical": alexical_rerank_list,
+}
+
+
+async def arerank_with_status(results, user_query, mode="pointwise"):
+    """
+    Async entry point that also reports whether the rerank completed
+    :param results: search results ordered by vector score
+    :param user_query: user's query
+    :param mode: name of a backend in RERANK_MODES
+    :return: reranked results, and False if the backend timed out or failed and kept vector order for some results
+    """
+    return await RERANK_MODES[mode](results, user_query)
+
+
+async def arerank(results, user_query, mode="pointwise"):
+    """
+    Async entry point, awaits the backend registered for mode in RERANK_MODES
+    :param results: search results ordered by vector score
+    :param user_query: user's query
+    :param mode: name of a backend in RERANK_MODES
+    :return: reranked results
+    """
+    reranked, _ = await arerank_with_status(results, user_query, mode)
+    return reranked
+
+
+def rerank_list(results, user_query, mode="pointwise"):
+    """
+    Sync entry point for callers without an event loop
+    :param results: search results ordered by vector score
+    :param user_query: user's query
+    :param mode: name of a backend in RERANK_MODES, "pointwise" (one Yes/No call per result),
+        "listwise" (one call in total) or "lexical" (local BM25, no LLM call)
+    :return: reranked results
+    """
+    return asyncio.run(arerank(results, user_query, mode))
@@ -1,169 +1,332 @@
 import os
 from dotenv import load_dotenv
 from ccs_website_data import  fetch_all_ccs_frameworks
-import requests
-from azure.storage.blob import ContainerClient, ExponentialRetry
-from pathlib import Path
+import aiohttp
+import asyncio
+import argparse
+import tempfile
+from azure.storage.blob.aio import ContainerClient, ExponentialRetry
+from pathlib import Path, PurePosixPath
 import zipfile
-import io
 import shutil
 import re
 import time
 
 load_dotenv()
-ccs_frameworks = fetch_all_ccs_frameworks()
 
-ccs_frameworks = ccs_frameworks[0:4]
 allowed_filetypes = ('.odt', '.docx', '.pdf', ".txt")
+ZIP_MAGIC = b'\x50\x4b\x03\x04'
+# downloads, zip entries and blob blocks are moved in pieces of this size so memory stays flat
+STREAM_CHUNK_SIZE = 1024 * 1024
+BLOB_BLOCK_SIZE = 4 * 1024 * 1024
 
 #get df and loop through all titles and download files into blob storage so it can be used for RAG
 base_url = os.getenv("BASE_URL")
-def zip_checker(url, data):
-    ZIP_MAGIC = b'\x50\x4b\x03\x04'
-    binary_data = data.content
+def zip_checker(url, head):
+    """ Whether a download is a zip, judged from its first bytes only
+
+    :param url(str): document url, files with an allowed extension are never treated as zips
+    :param head(bytes): first bytes of the file
+    :return(bool): True for a zip
+    """
     extension = Path(url)
     if extension.suffix in allowed_filetypes:
         return False
     # if bytes is less than 4 then it cannot be zip
-    if len(binary_data) < 4:
+    if len(head) < 4:
         return False
-    return binary_data[:4] == ZIP_MAGIC
+    return head[:4] == ZIP_MAGIC
 
 
 
 
-def unzipper_v2(data, rm_number):
-    base_dir = Path.cwd() / "unzipped_data"
+def unzipper_v2(zip_path, rm_number, base_dir):
     base_dir.mkdir(parents=True, exist_ok=True)
-    zip_stream = io.BytesIO(data.content)
-    return extract_recursive(zip_stream, base_dir, rm_number)
+    return extract_recursive(zip_path, base_dir, rm_number)
+
+
+def _copy_entry(zip_ref, info, target):
+    """ Stream one zip entry to target without holding it in memory """
+    with zip_ref.open(info) as source, open(target, "wb") as dest:
+        shutil.copyfileobj(source, dest, STREAM_CHUNK_SIZE)
 
 
 def extract_recursive(zip_input, extract_to, rm_number,
                       excluded_filenames=['mimetype', '.DS_Store', 'thumbs.db']):
-    unzipped_files = []
-    with zipfile.ZipFile(zip_input, 'r') as zip_ref:
-        zip_ref.extractall(path=extract_to)
+    """ Extract the allowed files of a zip entry by entry, descending into nested zips
 
-    # list() creates a snapshot so we don't iterate over changing filenames
-    current_items = list(extract_to.rglob('*'))
+    Only the entries that are kept are written, each one streamed to disk; a nested zip
+    is spooled to a temp file, extracted the same way and removed.
 
-    for item in current_items:
-        if not item.is_file():
-            continue
+    :param zip_input(Path): zip file on disk
+    :param extract_to(Path): directory the files are written to
+    :param rm_number(str): RM number the file names are prefixed with
+    :return(list): paths of the extracted files
+    """
+    unzipped_files = []
+    with zipfile.ZipFile(zip_input, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            # drop absolute and parent parts so an entry cannot be written outside extract_to
+            parts = [part for part in PurePosixPath(info.filename.replace("\\", "/")).parts if part not in ("/", "..", ".")]
+            if not parts:
+                continue
+            name = parts[-1]
+            target_dir = extract_to.joinpath(*parts[:-1])
+
+            # 1. Handle Valid Files
+            if Path(name).suffix in allowed_filetypes:
+                if name in excluded_filenames:
+                    continue
+                # ^RM\d+ matches RM + digits at the start. [_ ]* matches any underscores or spaces following.
+                clean_name = re.sub(r'^RM\d+[_ ]*', '', name, flags=re.IGNORECASE)
+                new_name = f"{rm_number}_{clean_name}"
+                target_dir.mkdir(parents=True, exist_ok=True)
+                _copy_entry(zip_ref, info, target_dir / new_name)
+                unzipped_files.append(target_dir / new_name)
+                continue
 
-        # 1. Handle Nested Zips
-        if zipfile.is_zipfile(item) and item.suffix not in allowed_filetypes:
-            nested_dir = item.with_suffix('')
-            nested_dir.mkdir(exist_ok=True)
-            unzipped_files.extend(extract_recursive(item, nested_dir, rm_number))
-            item.unlink()
+            # 2. Handle Nested Zips, sniffed from the first bytes of the entry
+            with zip_ref.open(info) as source:
+                head = source.read(len(ZIP_MAGIC))
+            if head != ZIP_MAGIC:
+                continue
+            nested_dir = target_dir / Path(name).stem
+            nested_dir.mkdir(parents=True, exist_ok=True)
+            fd, nested_path = tempfile.mkstemp(suffix=".zip", dir=extract_to)
+            os.close(fd)
+            try:
+                _copy_entry(zip_ref, info, nested_path)
+                unzipped_files.extend(extract_recursive(Path(nested_path), nested_dir, rm_number))
+            except zipfile.BadZipFile as e:
+                print(f"Skipping corrupt nested zip {info.filename}: {e}")
+            finally:
+                os.remove(nested_path)
 
-            # 2. Handle Valid Files
+    return unzipped_files
 
-        elif item.suffix in allowed_filetypes and  item.name not in excluded_filenames:
-            # ^RM\d+ matches RM + digits at the start. [_ ]* matches any underscores or spaces following.
-            clean_name = re.sub(r'^RM\d+[_ ]*', '', item.name, flags=re.IGNORECASE)
 
-            new_name = f"{rm_number}_{clean_name}"
-            new_path = item.with_name(new_name)
+async def download_to_tempfile(session, url, spool_dir):
+    """ Stream a download to a temp file in chunks
 
-            try:
-                # Only rename if the current name isn't already perfect
-                if item.name != new_name:
-                    item.rename(new_path)
-                    unzipped_files.append(new_path)
-                else:
-                    unzipped_files.append(item)
-            except FileNotFoundError:
-                if new_path.exists():
-                    unzipped_files.append(new_path)
+    :param session(aiohttp.ClientSession): pooled HTTP session
+    :param url(str): file to download
+    :param spool_dir(Path): directory the temp file is created in
+    :return(tuple): temp file path, its first bytes and its size
+    """
+    fd, path = tempfile.mkstemp(dir=spool_dir)
+    head = b""
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as spool:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    if len(head) < len(ZIP_MAGIC):
+                        head += chunk[:len(ZIP_MAGIC) - len(head)]
+                    spool.write(chunk)
+                    size += len(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return Path(path), head, size
 
-    return unzipped_files
 
 
 
 
+async def agreement_docs(session, frame_work):
+    """ Documents listed on a framework's page, None if the page could not be fetched
 
-def agreement_docs( frame_work):
+    :param session(aiohttp.ClientSession): pooled HTTP session
+    :param frame_work(str): RM number
+    :return(list): document dicts with a "url"
+    """
     try:
         new_url = base_url + frame_work
-        response = requests.get(new_url)
-        data = response.json()
-        # print(f"This is the data: {data}")
+        async with session.get(new_url) as response:
+            response.raise_for_status()
+            data = await response.json(content_type=None)
         documents = data['documents']
         return documents
     except Exception as e:
         print(f"This the error that caused the failed download {e}")
 
 
-def get_rm_page_data():
-    container_client = ContainerClient.from_connection_string(
+class UploadJob:
+    """ One file on disk waiting for upload, and the temp file or directory to remove after it """
+
+    def __init__(self, blob_name, path, metadata, group):
+        """
+        :param blob_name(str): name of the blob
+        :param path(Path): downloaded or unzipped file
+        :param metadata(dict): blob metadata (the rm_number used for filtering)
+        :param group(dict): files still to upload from the same download and the path to clean up after them
+        """
+        self.blob_name = blob_name
+        self.path = path
+        self.metadata = metadata
+        self.group = group
+
+    def done(self):
+        """ Remove the download's temp file or unzip directory once its last file has been uploaded """
+        self.group["remaining"] -= 1
+        if self.group["remaining"] == 0:
+            cleanup = self.group["cleanup"]
+            if cleanup.is_dir():
+                shutil.rmtree(cleanup, ignore_errors=True)
+            else:
+                cleanup.unlink(missing_ok=True)
+
+
+async def harvest_document(session, doc, frame_work, upload_queue, doc_slots, stats, spool_dir):
+    """ Download one framework document to a temp file and queue its files for upload """
+    async with doc_slots:
+        try:
+            data_url = doc["url"]
+            spool_path, head, size = await download_to_tempfile(session, data_url, spool_dir)
+            stats["downloaded_bytes"] += size
+        except Exception as e:
+            print(f"Error processing {doc.get('title')}: {e}")
+            stats["failed"] += 1
+            return
+
+    blob_metadata = {
+        "rm_number": frame_work
+    }
+    if not zip_checker(data_url, head):
+        # only allow  pdfs, docs and txt
+        if Path(data_url).suffix in allowed_filetypes:
+            original_name = Path(data_url).name
+            azure_file_name = original_name if frame_work in original_name else f"{frame_work}_{original_name}"
+            await upload_queue.put(UploadJob(azure_file_name, spool_path, blob_metadata, {"remaining": 1, "cleanup": spool_path}))
+        else:
+            spool_path.unlink(missing_ok=True)
+        return
+
+    # every zip gets its own directory, documents are unzipped concurrently
+    temp_dir = Path(tempfile.mkdtemp(prefix=f"{frame_work}_", dir=spool_dir))
+    try:
+        unzipped_files = await asyncio.to_thread(unzipper_v2, spool_path, frame_work, temp_dir)
+    except Exception as e:
+        print(f"Error unzipping {doc.get('title')}: {e}")
+        stats["failed"] += 1
+        unzipped_files = []
+    finally:
+        spool_path.unlink(missing_ok=True)
+    if not unzipped_files:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return
+    group = {"remaining": len(unzipped_files), "cleanup": temp_dir}
+    for unzipped_file in unzipped_files:
+        await upload_queue.put(UploadJob(unzipped_file.name, unzipped_file, blob_metadata, group))
+
+
+async def harvest_framework(session, frame_work, upload_queue, doc_slots, stats, spool_dir):
+    """ Fetch a framework's document list and download its documents concurrently """
+    documents = await agreement_docs(session, frame_work)
+    stats["frameworks"] += 1
+    if not documents:
+        return
+    stats["documents"] += len(documents)
+    await asyncio.gather(*(
+        harvest_document(session, doc, frame_work, upload_queue, doc_slots, stats, spool_dir) for doc in documents
+    ))
+    print(f"frame_work:{frame_work} documents:{len(documents)}")
+
+
+async def upload_worker(container_client, upload_queue, stats):
+    """ Upload queued files to blob storage while the downloads carry on """
+    while (job := await upload_queue.get()) is not None:
+        try:
+            blob_client = container_client.get_blob_client(job.blob_name)
+            # the client reads the file block by block (BLOB_BLOCK_SIZE), it is never loaded whole
+            with open(job.path, "rb") as file:
+                await blob_client.upload_blob(
+                    data=file, length=job.path.stat().st_size, overwrite=True, metadata=job.metadata
+                )
+            stats["uploaded"] += 1
+        except Exception as e:
+            print(f"Error uploading {job.blob_name}: {e}")
+            stats["failed"] += 1
+        finally:
+            job.done()
+
+
+async def get_rm_page_data(ccs_frameworks, concurrency=32, per_host=8, upload_workers=8, queue_size=64):
+    """ Download every framework's documents and upload them to blob storage with the rm_number metadata
+
+    Page and document requests share one pooled aiohttp session with at most per_host
+    connections to any host; downloads feed a bounded queue that upload_workers drain
+    into blob storage, so downloads and uploads overlap.
+
+    :param ccs_frameworks(pd.DataFrame): frameworks from fetch_all_ccs_frameworks
+    :param concurrency(int): documents downloading at the same time (and total connections)
+    :param per_host(int): connections to a single host
+    :param upload_workers(int): blob uploads in flight
+    :param queue_size(int): downloaded files waiting for upload before downloads pause
+    :return(dict): counts of frameworks, documents, uploaded files and failures
+    """
+    stats = {"frameworks": 0, "documents": 0, "uploaded": 0, "failed": 0, "downloaded_bytes": 0}
+    unzip_root = Path.cwd() / "unzipped_data"
+    unzip_root.mkdir(parents=True, exist_ok=True)
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120)
+    doc_slots = asyncio.Semaphore(concurrency)
+    upload_queue = asyncio.Queue(maxsize=queue_size)
+
+    async with ContainerClient.from_connection_string(
         conn_str=os.getenv("BLOB_CONNECTION_STRING"),
         container_name=os.getenv("BLOB_CONTAINER_NAME"),
-        retry_policy=ExponentialRetry(initial_backoff=2, retry_total=5)
-    )
-
-    with requests.Session() as session:
-        for index, row in ccs_frameworks.iterrows():
-            frame_work = row["rm_number"]
-            print(f"position:{index} frame_work:{frame_work}")
-            documents = agreement_docs(frame_work)
-
-            if not documents:
-                continue
-
-            # Create a specific folder for this RM to keep it clean
-            rm_temp_dir = Path.cwd() / "unzipped_data"
-            rm_temp_dir.mkdir(parents=True, exist_ok=True)
-
-            for doc in documents:
-                try:
-                    data_url = doc["url"]
-                    # print(data_url)
-                    # Use session for speed
-                    response = session.get(data_url, stream=True)
-
-                    # zip_checker needs to be careful not to exhaust RAM
-                    is_zip = zip_checker(data_url, response)
-                    blob_metadata = {
-                        "rm_number": frame_work
-                    }
-
-                    if not is_zip:
-                        # only allow  pdfs, docs and txt
-                        if Path(data_url).suffix in allowed_filetypes:
-                            original_name = Path(data_url).name
-
-                            azure_file_name = original_name if frame_work in original_name else f"{frame_work}_{original_name}"
-
-                            blob_client = container_client.get_blob_client(azure_file_name)
-                            blob_client.upload_blob(data=response.content, overwrite=True, metadata=blob_metadata)
-
-
-                    else:
-                        # Pass the specific temp dir to unzipper
-                        data_to_unzip = unzipper_v2(response, frame_work)
-                        for unzipped_file in data_to_unzip:
-
-                            blob_client = container_client.get_blob_client(unzipped_file.name)
-                            with open(unzipped_file, "rb") as file:
-                                blob_client.upload_blob(data=file, overwrite=True, metadata=blob_metadata)
-
-                except Exception as e:
-                    print(f"Error processing {doc.get('title')}: {e}")
-                    time.sleep(1)
-
-            # Cleanup AFTER all documents for this RM are done
-            if rm_temp_dir.exists():
-                shutil.rmtree(rm_temp_dir)
-
-
-
-start_time = time.perf_counter()
-get_rm_page_data()
-
-end_time = time.perf_counter()
-duration = end_time - start_time
-
-print(f"get_rm_page_data executed in {duration:.4f} seconds")
\ No newline at end of file
+        retry_policy=ExponentialRetry(initial_backoff=2, retry_total=5),
+        # anything larger than one block is uploaded as a series of blocks
+        max_single_put_size=BLOB_BLOCK_SIZE,
+        max_block_size=BLOB_BLOCK_SIZE,
+    ) as container_client, aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        uploaders = [asyncio.create_task(upload_worker(container_client, upload_queue, stats)) for _ in range(upload_workers)]
+        try:
+            await asyncio.gather(*(
+                harvest_framework(session, row["rm_number"], upload_queue, doc_slots, stats, unzip_root)
+                for _, row in ccs_frameworks.iterrows()
+            ))
+            for _ in uploaders:
+                await upload_queue.put(None)
+            await asyncio.gather(*uploaders)
+        finally:
+            for uploader in uploaders:
+                uploader.cancel()
+            shutil.rmtree(unzip_root, ignore_errors=True)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download CCS framework documents into blob storage for the RAG index")
+    parser.add_argument("--limit", type=int, default=None, help="only harvest the first N frameworks")
+    parser.add_argument("--concurrency", type=int, default=32, help="documents downloading at the same time")
+    parser.add_argument("--per-host", type=int, default=8, help="connections to a single host")
+    parser.add_argument("--upload-workers", type=int, default=8, help="blob uploads in flight")
+    args = parser.parse_args(argv)
+
+    ccs_frameworks = fetch_all_ccs_frameworks()
+    if ccs_frameworks is None:
+        print("No frameworks fetched, nothing to harvest")
+        return
+    if args.limit is not None:
+        ccs_frameworks = ccs_frameworks[0:args.limit]
+
+    start_time = time.perf_counter()
+    stats = asyncio.run(get_rm_page_data(
+        ccs_frameworks,
+        concurrency=args.concurrency,
+        per_host=args.per_host,
+        upload_workers=args.upload_workers,
+    ))
+    end_time = time.perf_counter()
+    duration = end_time - start_time
+
+    print(f"get_rm_page_data executed in {duration:.4f} seconds: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import math
+import threading
+import time
+import numpy as np
+from src.bm25 import BM25Index
+
+FACET_FIELDS = ("status", "regulation", "regulation_type", "pillar", "category")
+# the title is repeated so a match there outranks the same term deep in a description
+TITLE_WEIGHT = 2
+
+
+def agreement_text(agreement):
+    """ Text of an agreement that goes into the keyword index """
+    parts = [agreement.get("title", "")] * TITLE_WEIGHT
+    parts += [agreement.get("summary", ""), agreement.get("description", ""), agreement.get("keywords", "")]
+    return " ".join(parts)
+
+
+class AgreementSearchIndex:
+    """ BM25 search with facets and pagination over a fixed list of agreements
+
+    Facet values are held as one boolean mask per value, so filtering and
+    counting facets for a query are numpy ands and sums over ~hundreds of docs.
+    Facet counts for a field ignore that field's own selection, which lets the
+    page show how many results picking another value would give.
+    """
+
+    def __init__(self, agreements):
+        """
+        :param agreements(tuple): agreement records, see src.agreement_store.parse_agreement
+        """
+        start = time.perf_counter()
+        self.agreements = tuple(agreements)
+        self.num_docs = len(self.agreements)
+        self.bm25 = BM25Index([agreement_text(agreement) for agreement in self.agreements])
+        # field -> value -> mask of the agreements with that value
+        self.facet_masks = {}
+        for field in FACET_FIELDS:
+            values = np.array([agreement.get(field) or "" for agreement in self.agreements], dtype=object)
+            self.facet_masks[field] = {
+                value: values == value for value in sorted(set(values)) if value
+            }
+        # counts with no query or filter, served as is for the landing page
+        self.facet_counts = {
+            field: {value: int(mask.sum()) for value, mask in masks.items()}
+            for field, masks in self.facet_masks.items()
+        }
+        self.build_seconds = time.perf_counter() - start
+
+    def _filter_mask(self, filters, skip_field=None):
+        mask = np.ones(self.num_docs, dtype=bool)
+        for field, values in filters.items():
+            if field == skip_field or not values:
+                continue
+            masks = self.facet_masks.get(field, {})
+            selected = np.zeros(self.num_docs, dtype=bool)
+            for value in values:
+                if value in masks:
+                    selected |= masks[value]
+            mask &= selected
+        return mask
+
+    def search(self, query="", filters=None, page=1, page_size=20):
+        """ One page of agreements matching a query and facet filters
+
+        :param query(str): free text query, empty for every agreement in file order
+        :param filters(dict): facet field -> list of accepted values, values of a field are ORed
+        :param page(int): 1 based page number, clamped to the available pages
+        :param page_size(int): agreements per page
+        :return(dict): agreements for the page, total, page, pages and facet counts
+        """
+        filters = {field: values for field, values in (filters or {}).items() if field in self.facet_masks and values}
+        query = (query or "").strip()
+
+        if query:
+            scores = self.bm25.score(query)
+            query_mask = scores > 0
+        else:
+            scores = None
+            query_mask = np.ones(self.num_docs, dtype=bool)
+
+        matches = query_mask & self._filter_mask(filters)
+        doc_ids = np.flatnonzero(matches)
+        if scores is not None:
+            # stable sort keeps file order between equal scores
+            doc_ids = doc_ids[np.argsort(-scores[doc_ids], kind="stable")]
+
+        if not query and not filters:
+            facets = self.facet_counts
+        else:
+            facets = {}
+            for field, masks in self.facet_masks.items():
+                base = query_mask & self._filter_mask(filters, skip_field=field)
+                facets[field] = {value: int((mask & base).sum()) for value, mask in masks.items()}
+
+        total = len(doc_ids)
+        pages = max(1, math.ceil(total / page_size))
+        page = min(max(1, page), pages)
+        offset = (page - 1) * page_size
+        return {
+            "agreements": [self.agreements[doc_id] for doc_id in doc_ids[offset:offset + page_size]],
+            "total": total,
+            "page": page,
+            "pages": pages,
+            "page_size": page_size,
+            "facets": facets,
+        }
+
+
+class AgreementSearch:
+    """ Keeps an AgreementSearchIndex in step with an AgreementStore and times queries
+
+    The index is rebuilt whenever the store reloads its CSV.
+    """
+
+    def __init__(self, store):
+        """
+        :param store(AgreementStore): source of the agreements
+        """
+        self.store = store
+        self._lock = threading.Lock()
+        self._index = None
+        self._index_mtime = None
+        self.builds = 0
+        self.queries = 0
+        self.total_query_seconds = 0.0
+        self.max_query_seconds = 0.0
+
+    def index(self):
+        """ Search index for the store's current snapshot, rebuilt if the CSV changed
+
+        :return(AgreementSearchIndex): index
+        """
+        self.store.refresh()
+        if self._index is None or self._index_mtime != self.store.mtime:
+            with self._lock:
+                if self._index is None or self._index_mtime != self.store.mtime:
+                    # read the mtime before the agreements, a reload in between only costs an extra rebuild
+                    mtime = self.store.mtime
+                    self._index = AgreementSearchIndex(self.store.all())
+                    self._index_mtime = mtime
+                    self.builds += 1
+                    print(f"Built agreement search index: {self._index.num_docs} agreements, "
+                          f"{len(self._index.bm25.postings)} terms in {self._index.build_seconds * 1000:.1f} ms")
+        return self._index
+
+    def search(self, query="", filters=None, page=1, page_size=20):
+        """ Search the current index, see AgreementSearchIndex.search
+
+        :return(dict): search results with the query latency in took_ms
+        """
+        index = self.index()
+        start = time.perf_counter()
+        results = index.search(query, filters, page, page_size)
+        elapsed = time.perf_counter() - start
+        self.queries += 1
+        self.total_query_seconds += elapsed
+        self.max_query_seconds = max(self.max_query_seconds, elapsed)
+        results["took_ms"] = elapsed * 1000
+        return results
+
+    def stats(self):
+        """ Index size, build time and query latency
+
+        :return(dict): search metrics
+        """
+        index = self.index()
+        return {
+            "agreements": index.num_docs,
+            "terms": len(index.bm25.postings),
+            "builds": self.builds,
+            "build_ms": index.build_seconds * 1000,
+            "queries": self.queries,
+            "avg_query_ms": self.total_query_seconds * 1000 / self.queries if self.queries else 0.0,
+            "max_query_ms": self.max_query_seconds * 1000,
+        }
@@ -0,0 +1,137 @@
+import ast
+import csv
+import os
+import sys
+import threading
+from datetime import datetime
+
+# columns with a handful of distinct values, interned so every record shares the same string objects
+_CATEGORICAL_FIELDS = ("regulation", "regulation_type", "status", "pillar", "category")
+
+
+def format_date(date_str):
+    """ Convert a YYYY-MM-DD date to DD/MM/YYYY, anything else is returned unchanged """
+    if not date_str:
+        return ""
+    try:
+        return datetime.strptime(date_str, "%Y-%m-%d").strftime("%d/%m/%Y")
+    except Exception:
+        return date_str
+
+
+def parse_lots(lots_raw):
+    """ Parse the python literal stored in the lots column, an empty tuple when it is missing or malformed """
+    try:
+        parsed = ast.literal_eval(lots_raw or "[]")
+    except Exception:
+        return ()
+    return tuple(parsed) if isinstance(parsed, list) else ()
+
+
+def parse_agreement(row):
+    """ Turn a CSV row into the record the templates render
+
+    :param row(dict): row from csv.DictReader
+    :return(dict): agreement record
+    """
+    lots = parse_lots(row.get("lots"))
+    agreement = {
+        "id": row.get("id") or "",
+        "title": row.get("title") or "",
+        "rm_number": row.get("rm_number") or "",
+        "start_date": format_date(row.get("start_date") or ""),
+        "end_date": format_date(row.get("end_date") or ""),
+        "summary": row.get("summary") or "",
+        "description": row.get("description") or "",
+        "benefits": row.get("benefits") or "",
+        "how_to_buy": row.get("how_to_buy") or "",
+        "keywords": row.get("keywords") or "",
+        "lots": lots,
+        "lots_count": len(lots),
+    }
+    for field in _CATEGORICAL_FIELDS:
+        agreement[field] = sys.intern(row.get(field) or "")
+    # the templates call the regulation type the agreement type
+    agreement["agreement_type"] = agreement["regulation_type"]
+    return agreement
+
+
+class AgreementStore:
+    """ Parsed agreements from the website CSV, shared by every request
+
+    The file is parsed once and only re-read when its modification time changes,
+    so looking agreements up is cheap enough to do on every request. Records are
+    indexed by rm_number and id for O(1) agreement pages.
+    """
+
+    def __init__(self, path):
+        """
+        :param path(str): CSV exported from the website
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._agreements = ()
+        self._by_rm_number = {}
+        self._by_id = {}
+        self.load_count = 0
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8", newline="") as f:
+            agreements = tuple(parse_agreement(row) for row in csv.DictReader(f))
+        # first occurrence wins, matching the old linear scan
+        by_rm_number = {}
+        by_id = {}
+        for agreement in agreements:
+            by_rm_number.setdefault(agreement["rm_number"], agreement)
+            by_id.setdefault(agreement["id"], agreement)
+        return agreements, by_rm_number, by_id
+
+    def refresh(self):
+        """ Re-read the CSV if it changed since the last load
+
+        :return(bool): True if the file was (re)loaded
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return False
+        with self._lock:
+            if mtime == self._mtime:
+                return False
+            # swap the whole snapshot at once so readers never see a half built index
+            self._agreements, self._by_rm_number, self._by_id = self._load()
+            self._mtime = mtime
+            self.load_count += 1
+            print(f"Loaded {len(self._agreements)} agreements from {self.path}")
+        return True
+
+    def all(self):
+        """ Every agreement in file order
+
+        :return(tuple): agreement records
+        """
+        self.refresh()
+        return self._agreements
+
+    def by_rm_number(self, rm_number):
+        """ Agreement for an RM number, None if it is unknown
+
+        :param rm_number(str): e.g. RM6348
+        :return(dict | None): agreement record
+        """
+        self.refresh()
+        return self._by_rm_number.get(rm_number)
+
+    def by_id(self, agreement_id):
+        """ Agreement for a website id, None if it is unknown
+
+        :param agreement_id(str | int): id column of the CSV
+        :return(dict | None): agreement record
+        """
+        self.refresh()
+        return self._by_id.get(str(agreement_id))
+
+    @property
+    def mtime(self):
+        """ Modification time of the loaded snapshot, changes whenever the store reloads """
+        return self._mtime
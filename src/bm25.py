@@ -0,0 +1,112 @@
+import re
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset({
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have",
+    "in", "is", "it", "its", "of", "on", "or", "that", "the", "this", "to", "was",
+    "were", "will", "with", "you", "your", "can", "our", "we", "i", "me", "my",
+    "do", "does", "what", "which", "who", "how",
+})
+
+
+def tokenize(text):
+    """ Lower case a piece of text and split it into BM25 terms
+
+    :param text(str): text to split
+    :return(list): terms with stop words removed
+    """
+    if text is None:
+        return []
+    return [term for term in TOKEN_PATTERN.findall(str(text).lower()) if term not in STOP_WORDS]
+
+
+class BM25Index:
+    """ Okapi BM25 over a fixed corpus, stored as an inverted index of numpy arrays
+
+    Each posting list keeps the already length-normalised term weight for every
+    document, so scoring a query is a handful of vectorised adds, one per query term.
+    """
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        """
+        :param documents(list): text of every document in the corpus
+        :param k1(float): term frequency saturation
+        :param b(float): document length normalisation
+        """
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(documents)
+
+        doc_terms = [tokenize(document) for document in documents]
+        self.doc_lengths = np.array([len(terms) for terms in doc_terms], dtype=np.float32)
+        self.avg_doc_length = float(self.doc_lengths.mean()) if self.num_docs and self.doc_lengths.sum() else 1.0
+
+        raw_postings = {}
+        for doc_id, terms in enumerate(doc_terms):
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                raw_postings.setdefault(term, ([], []))
+                raw_postings[term][0].append(doc_id)
+                raw_postings[term][1].append(count)
+
+        length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / self.avg_doc_length)
+        self.idf = {}
+        self.postings = {}
+        for term, (doc_ids, counts) in raw_postings.items():
+            doc_ids = np.array(doc_ids, dtype=np.int32)
+            tf = np.array(counts, dtype=np.float32)
+            self.idf[term] = self._idf(len(doc_ids))
+            weights = self.idf[term] * tf * (self.k1 + 1) / (tf + length_norm[doc_ids])
+            self.postings[term] = (doc_ids, weights.astype(np.float32))
+        # terms never seen in the corpus are as rare as it gets
+        self.unseen_idf = self._idf(0)
+
+    def _idf(self, doc_freq):
+        return float(np.log(1 + (self.num_docs - doc_freq + 0.5) / (doc_freq + 0.5)))
+
+    def score(self, query):
+        """ Score every document in the corpus against a query
+
+        :param query(str): user's query
+        :return(np.ndarray): BM25 score per document, in corpus order
+        """
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is not None:
+                doc_ids, weights = posting
+                scores[doc_ids] += weights
+        return scores
+
+    def score_texts(self, query, texts):
+        """ Score texts that are not part of the corpus, using the corpus term statistics
+
+        All texts are scored in one batch: a (texts x query terms) count matrix is
+        built once and BM25 is applied to it with numpy broadcasting.
+
+        :param query(str): user's query
+        :param texts(list): candidate texts, e.g. title + description of search results
+        :return(np.ndarray): BM25 score per text, in the order given
+        """
+        query_terms = sorted(set(tokenize(query)))
+        if not texts or not query_terms:
+            return np.zeros(len(texts), dtype=np.float32)
+
+        column = {term: index for index, term in enumerate(query_terms)}
+        counts = np.zeros((len(texts), len(query_terms)), dtype=np.float32)
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            terms = tokenize(text)
+            lengths[row] = len(terms)
+            for term in terms:
+                index = column.get(term)
+                if index is not None:
+                    counts[row, index] += 1
+
+        idf = np.array([self.idf.get(term, self.unseen_idf) for term in query_terms], dtype=np.float32)
+        length_norm = self.k1 * (1 - self.b + self.b * lengths / self.avg_doc_length)
+        weights = counts * (self.k1 + 1) / (counts + length_norm[:, None])
+        return (weights * idf).sum(axis=1)
@@ -0,0 +1,154 @@
+import time
+import asyncio
+import sqlite3
+import threading
+from array import array
+from langchain_core.embeddings import Embeddings
+from src.ttl_cache import TTLCache
+
+
+def normalise_query(text):
+    """ Collapse whitespace so trivially different spellings of a query share a cache entry """
+    return " ".join(str(text).split())
+
+
+class SqliteEmbeddingStore:
+    """ On-disk backing store for query embeddings, shareable between processes
+
+    Expired rows are deleted when the store is opened and then every
+    purge_every writes, so the file does not grow with every query ever asked.
+    """
+
+    def __init__(self, path, ttl=None, purge_every=256):
+        """
+        :param path(str): sqlite file to keep the embeddings in
+        :param ttl(float): seconds a stored embedding stays valid, None to never expire
+        :param purge_every(int): writes between two deletes of expired rows
+        """
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._writes = 0
+        self.purged = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings "
+            "(model TEXT, query TEXT, vector BLOB, created_at REAL, PRIMARY KEY (model, query))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS query_embeddings_created_at ON query_embeddings (created_at)")
+        self._conn.commit()
+        self.purge()
+
+    def purge(self):
+        """ Delete the rows older than the ttl
+
+        :return(int): number of rows deleted
+        """
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM query_embeddings WHERE created_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+            self._conn.commit()
+        self.purged += deleted
+        return deleted
+
+    def get(self, model, query):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, created_at FROM query_embeddings WHERE model = ? AND query = ?",
+                (model, query)
+            ).fetchone()
+        if row is None:
+            return None
+        vector, created_at = row
+        if self.ttl is not None and created_at + self.ttl < time.time():
+            return None
+        return array("f", vector).tolist()
+
+    def set(self, model, query, vector):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?)",
+                (model, query, array("f", vector).tobytes(), time.time())
+            )
+            self._conn.commit()
+            self._writes += 1
+            due = self._writes % self.purge_every == 0
+        if due:
+            self.purge()
+
+
+class CachedEmbeddings(Embeddings):
+    """ Query embedding cache in front of any LangChain embeddings client
+
+    Lookups go in-process LRU/TTL cache first, then the optional on-disk store,
+    and only then the embeddings API. Entries are keyed on the embedding model name
+    and the normalised query text. Documents are passed straight through, they are
+    only embedded at ingestion time.
+    """
+
+    def __init__(self, embeddings, model_name, maxsize=4096, ttl=24 * 60 * 60, disk_path=None):
+        """
+        :param embeddings(Embeddings): client that actually calls the embeddings API
+        :param model_name(str): embedding model/deployment name, part of the cache key
+        :param maxsize(int): number of query embeddings kept in memory
+        :param ttl(float): seconds an embedding stays valid in memory and on disk
+        :param disk_path(str): optional sqlite file used as a shared backing store
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.disk = SqliteEmbeddingStore(disk_path, ttl=ttl) if disk_path else None
+        self.disk_hits = 0
+
+    def _from_disk(self, query):
+        vector = self.disk.get(self.model_name, query)
+        if vector is not None:
+            self.disk_hits += 1
+            self.memory.set((self.model_name, query), vector)
+        return vector
+
+    def embed_query(self, text):
+        query = normalise_query(text)
+        vector = self.memory.get((self.model_name, query))
+        if vector is None and self.disk is not None:
+            vector = self._from_disk(query)
+        if vector is None:
+            vector = self.embeddings.embed_query(query)
+            self.memory.set((self.model_name, query), vector)
+            if self.disk is not None:
+                self.disk.set(self.model_name, query, vector)
+        return vector
+
+    async def aembed_query(self, text):
+        query = normalise_query(text)
+        vector = self.memory.get((self.model_name, query))
+        # sqlite calls block, keep them off the event loop
+        if vector is None and self.disk is not None:
+            vector = await asyncio.to_thread(self._from_disk, query)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(query)
+            self.memory.set((self.model_name, query), vector)
+            if self.disk is not None:
+                await asyncio.to_thread(self.disk.set, self.model_name, query, vector)
+        return vector
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        return await self.embeddings.aembed_documents(texts)
+
+    def stats(self):
+        """ Hit/miss counters for the memory tier plus hits served from disk
+
+        :return(dict): cache metrics
+        """
+        stats = self.memory.stats()
+        stats["disk_hits"] = self.disk_hits
+        stats["disk_purged"] = self.disk.purged if self.disk is not None else 0
+        # a memory miss served from disk still saved an API call
+        stats["api_calls"] = stats["misses"] - self.disk_hits
+        return stats
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from src.multiturn_utils import build_graph
+
+
+class GraphRegistry:
+    """ Shares compiled LangGraph graphs across users and tracks active conversation threads
+
+    The compiled graph does not depend on the user, the thread_id and rm_filter travel
+    in the run config, so one graph is compiled per (llm, vector_store, checkpointer)
+    configuration and reused by every thread. The only per-thread state kept here is a
+    lock that stops two requests for the same thread from interleaving their checkpoint
+    writes. Each lock is reference counted by the turns holding or waiting for it and is
+    dropped when the last one leaves, so a lock in use is never replaced by a fresh one.
+    """
+
+    def __init__(self, build_fn=build_graph):
+        """
+        :param build_fn: function compiling a graph from llm, vector_store, checkpointer and options
+        """
+        self.build_fn = build_fn
+        self._graphs = {}
+        self._graphs_lock = threading.Lock()
+        # thread_id -> [lock, turns holding or waiting for it], only touched from the event loop
+        self._threads = {}
+        self.compiles = 0
+        self.peak_threads = 0
+
+    def get_graph(self, llm, vector_store, checkpointer, **options):
+        """ Return the compiled graph for this configuration, compiling it on first use
+
+        :param llm: chat model used by the graph nodes
+        :param vector_store: vector store the retrieve tool searches
+        :param checkpointer: checkpointer persisting thread state
+        :param options: extra keyword arguments passed to build_fn, part of the configuration key
+        :return: compiled graph
+        """
+        key = (id(llm), id(vector_store), id(checkpointer), tuple(sorted(options.items())))
+        entry = self._graphs.get(key)
+        if entry is None:
+            with self._graphs_lock:
+                entry = self._graphs.get(key)
+                if entry is None:
+                    graph = self.build_fn(llm=llm, vector_store=vector_store, checkpointer=checkpointer, **options)
+                    # keep the objects in the key alive so their ids cannot be reused by another configuration
+                    entry = (graph, (llm, vector_store, checkpointer))
+                    self._graphs[key] = entry
+                    self.compiles += 1
+        return entry[0]
+
+    @asynccontextmanager
+    async def thread_lock(self, thread_id):
+        """ Hold the lock serialising the turns of one conversation thread, use with async with
+
+        :param thread_id(str): conversation thread id (the user id in chatbot_api)
+        """
+        entry = self._threads.get(thread_id)
+        if entry is None:
+            entry = self._threads[thread_id] = [asyncio.Lock(), 0]
+            self.peak_threads = max(self.peak_threads, len(self._threads))
+        # counted before waiting, so the entry outlives a release that has a waiter queued behind it
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._threads[thread_id]
+
+    def stats(self):
+        """ Size metrics for the registry
+
+        :return(dict): number of compiled graphs, compiles so far and threads with a turn in flight
+        """
+        return {
+            "compiled_graphs": len(self._graphs),
+            "compiles": self.compiles,
+            "active_threads": len(self._threads),
+            "peak_active_threads": self.peak_threads,
+        }
@@ -0,0 +1,72 @@
+import re
+
+# RM6348, rm 6348, RM1557.13L4, RM1043iv
+RM_NUMBER_PATTERN = re.compile(r"\bRM\s*-?\s*(\d+(?:\.\d+)*(?:[a-z]+\d*)?)\b", re.IGNORECASE)
+# what may sit between RM numbers in a purely navigational query
+_NAVIGATIONAL_FILLER = re.compile(r"^[\s,;/&+]*(?:(?:and|or)[\s,;/&+]+)*$", re.IGNORECASE)
+
+
+def navigational_rm_numbers(query):
+    """ RM numbers of a query that is nothing but RM numbers, e.g. "RM6348" or "rm6348, RM6200"
+
+    Each RM comes back in the spellings it may be stored under (the prefix is always
+    upper case, suffixes such as L4 or iv are not consistent in the index), in the
+    order the user typed them.
+
+    :param query(str): user's query
+    :return(list | None): one list of candidate spellings per RM, None if the query has other words in it
+    """
+    matches = list(RM_NUMBER_PATTERN.finditer(query or ""))
+    if not matches:
+        return None
+    leftover = RM_NUMBER_PATTERN.sub(" ", query)
+    if not _NAVIGATIONAL_FILLER.match(leftover):
+        return None
+    rm_numbers = []
+    for match in matches:
+        suffix = match.group(1)
+        spellings = list(dict.fromkeys(["RM" + suffix, "RM" + suffix.upper(), "RM" + suffix.lower()]))
+        if spellings not in rm_numbers:
+            rm_numbers.append(spellings)
+    return rm_numbers
+
+
+def reciprocal_rank_fusion(result_lists, key="id", k=60):
+    """ Merge ranked result lists with reciprocal rank fusion
+
+    A result scores sum(1 / (k + rank)) over the lists it appears in, so documents found
+    by both keyword and vector search rise to the top without having to compare BM25 and
+    cosine scores. The fused score replaces @search.score on the returned results.
+
+    :param result_lists(list): ranked lists of search results, best first
+    :param key(str): field identifying the same document across lists
+    :param k(int): rank constant, larger values flatten the contribution of the top ranks
+    :return(list): fused results, best first
+    """
+    fused = {}
+    scores = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            doc_key = result[key]
+            fused.setdefault(doc_key, result)
+            scores[doc_key] = scores.get(doc_key, 0.0) + 1.0 / (k + rank)
+    ordered = sorted(fused, key=lambda doc_key: scores[doc_key], reverse=True)
+    return [{**fused[doc_key], "@search.score": scores[doc_key]} for doc_key in ordered]
+
+
+def unique_by_title(results, limit):
+    """ First result for each framework title, the index holds several chunks per framework
+
+    :param results(list): search results, best first
+    :param limit(int): maximum number of results to keep
+    :return(list): results with distinct titles
+    """
+    top_results = []
+    seen_titles = set()
+    for res in results:
+        if res["title"] not in seen_titles:
+            top_results.append(res)
+            seen_titles.add(res["title"])
+        if len(top_results) == limit:
+            break
+    return top_results
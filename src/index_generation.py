@@ -0,0 +1,46 @@
+import os
+import time
+
+# marker file shared between the ingestion script and the search API,
+# must be on storage both can see when they run on different hosts
+INDEX_GENERATION_PATH = os.getenv(
+    "INDEX_GENERATION_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "index_generation.txt")
+)
+
+# marker path -> (mtime, generation) it was last read at
+_last_seen = {}
+
+
+def read_index_generation(path=INDEX_GENERATION_PATH):
+    """ Current generation of the search index, "0" if it has never been bumped
+
+    The file is only re-read when its modification time changes, so this is
+    cheap enough to call on every request.
+
+    :param path(str): marker file written by bump_index_generation
+    :return(str): generation marker
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return "0"
+    seen = _last_seen.get(path)
+    if seen is None or seen[0] != mtime:
+        with open(path, "r", encoding="utf-8") as f:
+            seen = _last_seen[path] = (mtime, f.read().strip() or "0")
+    return seen[1]
+
+
+def bump_index_generation(path=INDEX_GENERATION_PATH):
+    """ Mark the search index as changed, call this after every upload to the index
+
+    :param path(str): marker file read by read_index_generation
+    :return(str): the new generation marker
+    """
+    generation = str(time.time_ns())
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(generation)
+    os.replace(tmp_path, path)
+    return generation
@@ -0,0 +1,373 @@
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from types import SimpleNamespace
+import numpy as np
+from src.bm25 import BM25Index
+
+VECTORS_FILE = "vectors.npy"
+DOCUMENTS_FILE = "documents.json"
+# names the generation directory holding the current vectors and documents
+CURRENT_FILE = "CURRENT"
+GENERATION_PREFIX = "gen-"
+
+_EQ_CLAUSE = re.compile(r"^(\w+)\s+eq\s+'((?:[^']|'')*)'$")
+_SEARCH_IN_CLAUSE = re.compile(r"^search\.in\(\s*(\w+)\s*,\s*'((?:[^']|'')*)'\s*(?:,\s*'([^']*)'\s*)?\)$")
+_AND = re.compile(r"\s+and\s+", re.IGNORECASE)
+
+
+def parse_filter(filter_expr):
+    """ Parse the subset of OData this repo sends to the search index
+
+    Supports `field eq 'value'` and `search.in(field, 'a,b', ',')` clauses joined with `and`.
+
+    :param filter_expr(str): OData filter, None or "" for no filter
+    :return(list): (field, set of accepted values) per clause
+    """
+    clauses = []
+    for clause in _AND.split(filter_expr.strip()) if filter_expr else []:
+        clause = clause.strip()
+        while clause.startswith("(") and clause.endswith(")"):
+            clause = clause[1:-1].strip()
+        if match := _EQ_CLAUSE.match(clause):
+            clauses.append((match.group(1), {match.group(2).replace("''", "'")}))
+        elif match := _SEARCH_IN_CLAUSE.match(clause):
+            separator = match.group(3) or ","
+            values = match.group(2).replace("''", "'").split(separator)
+            clauses.append((match.group(1), {value.strip() for value in values}))
+        else:
+            raise ValueError(f"Unsupported filter for the local index: {filter_expr!r}")
+    return clauses
+
+
+class _Results:
+    """ Async iterable over a finished result list, the shape `await SearchClient.search(...)` returns """
+
+    def __init__(self, results):
+        self._results = results
+
+    async def _iterate(self):
+        for result in self._results:
+            yield result
+
+    def __aiter__(self):
+        return self._iterate()
+
+    def __iter__(self):
+        return iter(self._results)
+
+
+class LocalVectorIndex:
+    """ In-process stand-in for the Azure AI Search index of framework chunks
+
+    Vectors live in one contiguous, row-normalised float32 matrix, so a k-NN query is a
+    single matrix-vector product plus an argpartition. The index covers the parts of the
+    search API this repo uses: vector queries, keyword search (BM25 over title and
+    description), `eq`/`search.in` filters, select, top and skip. Uploads go through
+    the same merge_or_upload/merge/delete_documents calls as SearchClient, so the
+    ingestion script can fill it, and it is saved as a .npy matrix that is memory
+    mapped on load.
+
+    Search is async, like the aio SearchClient, while the document methods are sync,
+    like the sync SearchClient used by the ingestion script.
+    """
+
+    def __init__(self, documents=(), vectors=None, key="id", vector_field="embedding", text_fields=("title", "description")):
+        """
+        :param documents(list): documents without their vector field, in matrix row order
+        :param vectors(np.ndarray): (len(documents), dims) matrix, normalised on the way in
+        :param key(str): document key field
+        :param vector_field(str): field the vectors are uploaded in
+        :param text_fields(tuple): fields the keyword search looks at
+        """
+        self.key = key
+        self.vector_field = vector_field
+        self.text_fields = text_fields
+        self._lock = threading.Lock()
+        self._documents = list(documents)
+        self._rows = {document[key]: row for row, document in enumerate(self._documents)}
+        self._vectors = self._normalise(vectors) if vectors is not None else np.zeros((len(self._documents), 0), dtype=np.float32)
+        self._columns = {}
+        self._bm25 = None
+
+    @staticmethod
+    def _normalise(vectors):
+        if isinstance(vectors, np.memmap) or (isinstance(vectors, np.ndarray) and not vectors.flags.writeable):
+            # saved matrices are already normalised, keep the mapping instead of copying it into memory
+            return vectors
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if vectors.size:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            vectors = vectors / norms
+        return vectors
+
+    @classmethod
+    def from_documents(cls, documents, **kwargs):
+        """ Build an index from documents shaped like the ones embed_for_simple_ai_search.py uploads
+
+        :param documents(list): documents including their vector field
+        :return(LocalVectorIndex): index
+        """
+        index = cls(**kwargs)
+        index.merge_or_upload_documents(documents=list(documents))
+        return index
+
+    def __len__(self):
+        return len(self._documents)
+
+    # --- persistence ---
+
+    @staticmethod
+    def _current_dir(path):
+        """ Directory holding the saved vectors and documents, path itself for indexes saved before CURRENT existed """
+        try:
+            with open(os.path.join(path, CURRENT_FILE), "r", encoding="utf-8") as f:
+                return os.path.join(path, f.read().strip())
+        except FileNotFoundError:
+            return path
+
+    def save(self, path):
+        """ Write the index to a directory: the matrix as .npy and the documents as json
+
+        Both files go into a new generation directory and CURRENT is then swapped to
+        point at it, so a reader opening the index while it is saved gets either the
+        old pair or the new pair, never new vectors with old documents. The generation
+        CURRENT pointed at before is kept for readers that were already opening it,
+        older ones are removed.
+
+        :param path(str): directory, created if missing
+        """
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            vectors, documents = self._vectors, list(self._documents)
+        previous = os.path.basename(self._current_dir(path))
+        generation = f"{GENERATION_PREFIX}{time.time_ns()}"
+        generation_dir = os.path.join(path, generation)
+        os.makedirs(generation_dir)
+        with open(os.path.join(generation_dir, VECTORS_FILE), "wb") as f:
+            np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+        with open(os.path.join(generation_dir, DOCUMENTS_FILE), "w", encoding="utf-8") as f:
+            json.dump({"key": self.key, "vector_field": self.vector_field, "documents": documents}, f)
+        current_tmp = os.path.join(path, CURRENT_FILE + ".tmp")
+        with open(current_tmp, "w", encoding="utf-8") as f:
+            f.write(generation)
+        os.replace(current_tmp, os.path.join(path, CURRENT_FILE))
+
+        for name in os.listdir(path):
+            if name.startswith(GENERATION_PREFIX) and name not in (generation, previous):
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """ Open an index written by save
+
+        :param path(str): directory written by save
+        :param mmap(bool): memory map the matrix read only instead of reading it into memory
+        :return(LocalVectorIndex): index
+        """
+        current_dir = cls._current_dir(path)
+        with open(os.path.join(current_dir, DOCUMENTS_FILE), "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        vectors = np.load(os.path.join(current_dir, VECTORS_FILE), mmap_mode="r" if mmap else None)
+        if len(vectors) != len(saved["documents"]):
+            raise ValueError(f"Local index at {path} has {len(vectors)} vectors for {len(saved['documents'])} documents")
+        return cls(saved["documents"], vectors, key=saved["key"], vector_field=saved["vector_field"])
+
+    @classmethod
+    def load_or_create(cls, path, **kwargs):
+        """ load the index at path, or an empty index if nothing has been saved there yet """
+        if os.path.exists(os.path.join(cls._current_dir(path), DOCUMENTS_FILE)):
+            return cls.load(path, mmap=False)
+        return cls(**kwargs)
+
+    # --- SearchClient document methods, used by index_in_batches ---
+
+    def _result(self, key):
+        return SimpleNamespace(key=key, succeeded=True, status_code=200, error_message=None)
+
+    def _changed(self):
+        self._columns = {}
+        self._bm25 = None
+
+    def merge_or_upload_documents(self, documents):
+        """ Insert documents or replace the fields they carry, like SearchClient.merge_or_upload_documents """
+        with self._lock:
+            vectors = self._vectors
+            if not vectors.flags.writeable:
+                # a loaded matrix is mapped read only, updates go to an in-memory copy
+                vectors = np.array(vectors, dtype=np.float32)
+            new_rows = []
+            for document in documents:
+                document = dict(document)
+                vector = document.pop(self.vector_field, None)
+                row = self._rows.get(document[self.key])
+                if row is None:
+                    if vector is None:
+                        raise ValueError(f"New document {document[self.key]} has no {self.vector_field}")
+                    self._rows[document[self.key]] = len(self._documents)
+                    self._documents.append(document)
+                    new_rows.append(vector)
+                else:
+                    self._documents[row] = {**self._documents[row], **document}
+                    if vector is not None:
+                        vectors[row] = self._normalise(np.asarray([vector]))[0]
+            if new_rows:
+                new_rows = self._normalise(np.asarray(new_rows))
+                vectors = np.vstack([vectors, new_rows]) if vectors.size else new_rows
+            self._vectors = np.ascontiguousarray(vectors)
+            self._changed()
+        return [self._result(document[self.key]) for document in documents]
+
+    def merge_documents(self, documents):
+        """ Update fields of existing documents, unknown keys fail like they do in Azure """
+        results = []
+        known = []
+        for document in documents:
+            if document[self.key] in self._rows:
+                known.append(document)
+                results.append(self._result(document[self.key]))
+            else:
+                results.append(SimpleNamespace(
+                    key=document[self.key], succeeded=False, status_code=404, error_message="Document not found"
+                ))
+        if known:
+            self.merge_or_upload_documents(documents=known)
+        return results
+
+    def delete_documents(self, documents):
+        """ Delete documents by key, like SearchClient.delete_documents """
+        with self._lock:
+            doomed = {self._rows[document[self.key]] for document in documents if document[self.key] in self._rows}
+            if doomed:
+                keep = np.ones(len(self._documents), dtype=bool)
+                keep[list(doomed)] = False
+                self._vectors = np.ascontiguousarray(self._vectors[keep])
+                self._documents = [document for row, document in enumerate(self._documents) if keep[row]]
+                self._rows = {document[self.key]: row for row, document in enumerate(self._documents)}
+                self._changed()
+        return [self._result(document[self.key]) for document in documents]
+
+    # --- search ---
+
+    def _column(self, field):
+        column = self._columns.get(field)
+        if column is None:
+            column = self._columns[field] = np.array([document.get(field) for document in self._documents], dtype=object)
+        return column
+
+    def _filter_mask(self, filter_expr):
+        mask = np.ones(len(self._documents), dtype=bool)
+        for field, values in parse_filter(filter_expr):
+            column = self._column(field)
+            mask &= np.isin(column, list(values)) if len(values) > 1 else column == next(iter(values))
+        return mask
+
+    def _keyword_scores(self, search_text):
+        if self._bm25 is None:
+            self._bm25 = BM25Index([
+                " ".join(str(document.get(field) or "") for field in self.text_fields) for document in self._documents
+            ])
+        return self._bm25.score(search_text)
+
+    def search_sync(self, search_text=None, vector_queries=None, filter=None, select=None, top=50, skip=0, **kwargs):
+        """ Run a search, see search for the parameters
+
+        :return(list): results with @search.score, best first
+        """
+        num_docs = len(self._documents)
+        if not num_docs:
+            return []
+        mask = self._filter_mask(filter)
+
+        if vector_queries:
+            if len(vector_queries) > 1:
+                raise ValueError("The local index supports a single vector query")
+            vector_query = vector_queries[0]
+            query = np.asarray(vector_query.vector, dtype=np.float32)
+            norm = np.linalg.norm(query)
+            cosine = self._vectors @ (query / norm if norm else query)
+            # the score Azure reports for cosine similarity
+            scores = 1.0 / (2.0 - cosine)
+            limit = vector_query.k_nearest_neighbors or top
+            if search_text not in (None, "", "*"):
+                raise ValueError("The local index does not combine keyword and vector search in one call")
+        elif search_text not in (None, "", "*"):
+            scores = self._keyword_scores(search_text)
+            mask &= scores > 0
+            limit = num_docs
+        else:
+            scores = np.ones(num_docs, dtype=np.float32)
+            limit = num_docs
+
+        candidates = np.flatnonzero(mask)
+        limit = min(limit, len(candidates))
+        if limit < len(candidates):
+            # only the k best candidates are sorted
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        page = candidates[skip:skip + top] if top is not None else candidates[skip:]
+
+        results = []
+        for row in page:
+            document = self._documents[row]
+            result = {field: document.get(field) for field in select} if select else dict(document)
+            result["@search.score"] = float(scores[row])
+            results.append(result)
+        return results
+
+    async def search(self, search_text=None, vector_queries=None, filter=None, select=None, top=50, skip=0, **kwargs):
+        """ Same call shape as the aio SearchClient.search, await it then iterate with async for
+
+        :param search_text(str): keyword query, None or "*" for no keyword scoring
+        :param vector_queries(list): one VectorizedQuery (vector, k_nearest_neighbors)
+        :param filter(str): OData filter, see parse_filter
+        :param select(list): fields to return, None for all of them
+        :param top(int): results to return
+        :param skip(int): results to skip
+        :return(_Results): async iterable of results
+        """
+        return _Results(self.search_sync(search_text, vector_queries, filter, select, top, skip))
+
+    def get_document_count(self):
+        return len(self._documents)
+
+    async def close(self):
+        """ Nothing to close, here so the index can replace the aio SearchClient """
+        return None
+
+
+class LocalVectorStore:
+    """ The similarity_search surface of LangChain's AzureSearch, over a LocalVectorIndex """
+
+    def __init__(self, index, embeddings, content_key="description"):
+        """
+        :param index(LocalVectorIndex): index to search
+        :param embeddings: LangChain embeddings used for the query
+        :param content_key(str): field returned as page_content
+        """
+        self.index = index
+        self.embeddings = embeddings
+        self.content_key = content_key
+
+    def _documents(self, query_vector, k, filters):
+        from langchain_core.documents import Document
+
+        vector_query = SimpleNamespace(vector=query_vector, k_nearest_neighbors=k)
+        results = self.index.search_sync(vector_queries=[vector_query], filter=filters, top=k)
+        return [
+            Document(
+                page_content=result.get(self.content_key) or "",
+                metadata={field: value for field, value in result.items() if field != self.content_key},
+            )
+            for result in results
+        ]
+
+    def similarity_search(self, query, k=4, filters=None, **kwargs):
+        return self._documents(self.embeddings.embed_query(query), k, filters)
+
+    async def asimilarity_search(self, query, k=4, filters=None, **kwargs):
+        return self._documents(await self.embeddings.aembed_query(query), k, filters)
@@ -1,48 +1,179 @@
 from typing import Any, Iterator, Dict
 from functools import partial, wraps, WRAPPER_ASSIGNMENTS
-from langchain_core.tools import tool
-from langchain_core.messages import SystemMessage, BaseMessage, HumanMessage
+from langchain_core.tools import StructuredTool
+from langchain_core.messages import SystemMessage, BaseMessage, HumanMessage, AIMessage, RemoveMessage
 from langchain_core.documents.base import Document
 from langgraph.graph import MessagesState, StateGraph, END
 from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode, tools_condition
 from langgraph.checkpoint.memory import MemorySaver
 from typing import TypedDict, Annotated, List, Any, Iterator, Dict, Union
-from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from typing import AsyncIterator
+import asyncio
+import inspect
 
 class AgentState(TypedDict):
     """The state of the agent, containing the conversation history."""
     messages: Annotated[List[BaseMessage], add_messages]
     last_rm_label: str
+    # rolling summary of the turns manage_history has folded out of messages
+    summary: str
+
+def _is_tool_step(message):
+    """Tool results and the AI messages that requested them, only needed during their own turn"""
+    return message.type == "tool" or (message.type == "ai" and bool(getattr(message, "tool_calls", None)))
+
+def _plan_history(state, history_turns: int, summary_batch_turns: int):
+    """
+    Work out which messages manage_history folds into the summary and which it removes.
+
+    A turn starts at a human message. The current turn and the previous history_turns
+    turns are kept verbatim; once summary_batch_turns more have piled up on top of
+    those, the oldest are folded into the summary in one go, so the summary LLM call
+    happens every summary_batch_turns turns rather than on every turn. Tool messages
+    and tool-call requests of earlier turns are always dropped.
+
+    :return(tuple): messages to summarise, messages to remove
+    """
+    messages = state["messages"]
+    turn_starts = [i for i, message in enumerate(messages) if message.type == "human"]
+    if not turn_starts:
+        return [], []
+    current_turn = turn_starts[-1]
+    cutoff = 0
+    if len(turn_starts) > history_turns + 1 + summary_batch_turns:
+        cutoff = turn_starts[-(history_turns + 1)]
+    to_summarise = [m for m in messages[:cutoff] if not _is_tool_step(m)]
+    to_remove = messages[:cutoff] + [m for m in messages[cutoff:current_turn] if _is_tool_step(m)]
+    return to_summarise, to_remove
+
+def _summary_prompt(summary: str, messages):
+    """Prompt extending the rolling summary with the turns being folded out of the history"""
+    transcript = "\n".join(
+        f"{'User' if message.type == 'human' else 'Assistant'}: {message.content}"
+        for message in messages
+    )
+    return [
+        SystemMessage(
+            "You maintain a running summary of a conversation between a user and an assistant about "
+            "Crown Commercial Service agreements. Extend the existing summary with the new lines. Keep "
+            "RM numbers, agreement names and any facts or preferences the user stated. Reply with the "
+            "summary only, in at most 150 words."
+        ),
+        HumanMessage(f"Existing summary:\n{summary or '(none)'}\n\nNew lines:\n{transcript}"),
+    ]
+
+def _history_update(state, to_summarise, to_remove, summary):
+    update = {}
+    if to_summarise:
+        update["summary"] = summary
+    if to_remove:
+        update["messages"] = [RemoveMessage(id=message.id) for message in to_remove]
+    return update
+
+def manage_history(state: AgentState, llm: Any, history_turns: int, summary_batch_turns: int):
+    """Keep the last history_turns turns verbatim, fold older ones into the summary and drop stale tool messages"""
+    to_summarise, to_remove = _plan_history(state, history_turns, summary_batch_turns)
+    summary = state.get("summary", "")
+    if to_summarise:
+        summary = llm.invoke(_summary_prompt(summary, to_summarise)).content
+    return _history_update(state, to_summarise, to_remove, summary)
+
+async def amanage_history(state: AgentState, llm: Any, history_turns: int, summary_batch_turns: int):
+    """Async version of manage_history"""
+    to_summarise, to_remove = _plan_history(state, history_turns, summary_batch_turns)
+    summary = state.get("summary", "")
+    if to_summarise:
+        summary = (await llm.ainvoke(_summary_prompt(summary, to_summarise))).content
+    return _history_update(state, to_summarise, to_remove, summary)
+
+def _with_summary(state):
+    """Conversation messages, preceded by the rolling summary when there is one"""
+    summary = state.get("summary")
+    if summary:
+        return [SystemMessage(f"Summary of the earlier conversation: {summary}")] + state["messages"]
+    return state["messages"]
 
 def query_or_respond(state: MessagesState, llm: Any, retrieve_tool: Any):
     "Generate tool call for retrieval, or respond directly"
     llm_with_tools = llm.bind_tools([retrieve_tool])
-    response = llm_with_tools.invoke(state["messages"])
+    response = llm_with_tools.invoke(_with_summary(state))
     # the response will contain the most recent response and the previous responses
     return {"messages": [response]}
 
-def create_bound_retrieve_tool(vector_store):
-    """Create a properly decorated retrieve tool bound to a specific vector store"""
-    @tool(response_format="content_and_artifact")
+async def aquery_or_respond(state: MessagesState, llm: Any, retrieve_tool: Any):
+    "Async version of query_or_respond, used when the graph is run with astream/ainvoke"
+    llm_with_tools = llm.bind_tools([retrieve_tool])
+    response = await llm_with_tools.ainvoke(_with_summary(state))
+    return {"messages": [response]}
+
+def rm_search_filter(rm_filter):
+    """Build the Azure Search filter for an RM label, None (no filter) when the label is unknown"""
+    if rm_filter is not None and rm_filter != "UNKNOWN":
+        return f"rm_number eq '{rm_filter}'"
+    return None
+
+def _search_filter(config: RunnableConfig):
+    """Build the Azure Search filter for the RM label the labeller put in the config"""
+    rm_filter = config["configurable"].get("rm_filter")
+    print(f"rm_filter: {rm_filter}")
+    return rm_search_filter(rm_filter)
+
+def _serialize_docs(retrieved_docs):
+    return "\n\n".join(
+        f"Source: {doc.metadata}\nContent: {doc.page_content}"
+        for doc in retrieved_docs
+    )
+
+def create_bound_retrieve_tool(vector_store, retrieval_cache=None):
+    """Create a retrieve tool bound to a specific vector store, with both sync and async implementations
+
+    :param vector_store: vector store to search
+    :param retrieval_cache(RetrievalCache): optional cache consulted before searching
+    """
     def retrieve_bound(query: str, config: RunnableConfig):
-        """Retrieve information related to a query"""
         rm_filter = config["configurable"].get("rm_filter")
+        retrieved_docs = retrieval_cache.lookup(query, rm_filter) if retrieval_cache is not None else None
+        if retrieved_docs is None:
+            retrieved_docs = vector_store.similarity_search(query, k=5, filters=_search_filter(config))
+            if retrieval_cache is not None:
+                retrieval_cache.store(query, rm_filter, retrieved_docs)
+        return _serialize_docs(retrieved_docs), retrieved_docs
+
+    async def aretrieve_bound(query: str, config: RunnableConfig):
+        configurable = config["configurable"]
+        rm_filter = configurable.get("rm_filter")
+        # in the speculative pipeline the label is still being worked out when the tool is called
+        if inspect.isawaitable(rm_filter):
+            rm_filter = await rm_filter
         print(f"rm_filter: {rm_filter}")
-        if rm_filter is not None and rm_filter != "UNKNOWN":
-            search_filter = f"rm_number eq '{rm_filter}'"
-        else:
-            search_filter = None
-        retrieved_docs = vector_store.similarity_search(query, k=5, filters=search_filter)
-        serialized = "\n\n".join(
-            f"Source: {doc.metadata}\nContent: {doc.page_content}"
-            for doc in retrieved_docs
-        )
-        return serialized, retrieved_docs
-    return retrieve_bound
+        speculative = (configurable.get("speculative_retrievals") or {}).get(rm_filter or "UNKNOWN")
+        if speculative is not None:
+            try:
+                retrieved_docs = await speculative
+                return _serialize_docs(retrieved_docs), retrieved_docs
+            except Exception as e:
+                print(f"Speculative retrieval failed, searching again: {e!r}")
+        if retrieval_cache is not None:
+            retrieved_docs = await retrieval_cache.alookup(query, rm_filter)
+            if retrieved_docs is not None:
+                return _serialize_docs(retrieved_docs), retrieved_docs
+        retrieved_docs = await vector_store.asimilarity_search(query, k=5, filters=rm_search_filter(rm_filter))
+        if retrieval_cache is not None:
+            await retrieval_cache.astore(query, rm_filter, retrieved_docs)
+        return _serialize_docs(retrieved_docs), retrieved_docs
 
-def generate(state: MessagesState, llm: Any):
-    """Generate answer"""
+    return StructuredTool.from_function(
+        func=retrieve_bound,
+        coroutine=aretrieve_bound,
+        name="retrieve_bound",
+        description="Retrieve information related to a query",
+        response_format="content_and_artifact",
+    )
+
+def _generate_prompt(state: MessagesState):
+    """Build the answer prompt from the most recent tool messages and the conversation"""
     # capture the most recent tool messages
     recent_tool_messages = []
     for message in reversed(state["messages"]):
@@ -63,14 +194,24 @@ def generate(state: MessagesState, llm: Any):
         "\n\n"
         f"{docs_content}"
     )
+    if state.get("summary"):
+        system_message_content += f"\n\nSummary of the earlier conversation: {state['summary']}"
     conversation_messages = [
         message
         for message in state["messages"]
         if message.type in ("human", "system")
         or (message.type == "ai" and not message.tool_calls)
     ]
-    prompt = [SystemMessage(system_message_content)] + conversation_messages
-    response = llm.invoke(prompt)
+    return [SystemMessage(system_message_content)] + conversation_messages
+
+def generate(state: MessagesState, llm: Any):
+    """Generate answer"""
+    response = llm.invoke(_generate_prompt(state))
+    return {"messages": [response]}
+
+async def agenerate(state: MessagesState, llm: Any):
+    """Async version of generate"""
+    response = await llm.ainvoke(_generate_prompt(state))
     return {"messages": [response]}
 
 def stream_turn(
@@ -93,6 +234,38 @@ def stream_turn(
         config=config,
     )
 
+async def astream_turn(
+    graph,
+    user_input: str,
+    config: dict,
+    thread_id: str = "abc123",
+    stream_mode: str = "values",
+
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Async version of stream_turn, yields the values dicts produced by graph.astream(...).
+    """
+    async for step in graph.astream(
+        {"messages": [{"role": "user", "content": user_input}]},
+        stream_mode=stream_mode,
+        config=config,
+    ):
+        yield step
+
+def _read_step(step, final_messages, last_ai_content):
+    """Track the latest message list and content seen while streaming values"""
+    # in case there have been no messages yet, use `get` to pass a default value (empty list)
+    messages = step.get("messages", [])
+    if messages:
+        final_messages = messages
+        msg = messages[-1]
+        # extract content, handling cases where messages are either dicts or object attributes
+        if hasattr(msg, "content"):
+            last_ai_content = msg.content
+        elif isinstance(msg, dict):
+            last_ai_content = msg.get("content", last_ai_content)
+    return final_messages, last_ai_content
+
 def answer_once(
     graph,
     user_input: str,
@@ -111,17 +284,168 @@ def answer_once(
     final_messages = []
 
     for step in stream_turn(graph=graph, user_input=user_input, config=config, thread_id=thread_id):
-        # in case there have been no messages yet, use `get` to pass a default value (empty list)
-        messages = step.get("messages", [])
-        if messages:
-            final_messages = messages
-            msg = messages[-1]
-            # extract content, handling cases where messages are either dicts or object attributes
-            if hasattr(msg, "content"):
-                last_ai_content = msg.content
-            elif isinstance(msg, dict):
-                last_ai_content = msg.get("content", last_ai_content)
+        final_messages, last_ai_content = _read_step(step, final_messages, last_ai_content)
+
+    return _collect_answer(final_messages, last_ai_content)
 
+async def aanswer_once(
+    graph,
+    user_input: str,
+    thread_id: str = "abc123",
+    config: dict = None
+):
+    """
+    Async version of answer_once, runs the turn with graph.astream so the event loop is
+    free while the LLM, the retrieval and the checkpointer are working.
+    """
+    last_ai_content = ""
+    final_messages = []
+
+    async for step in astream_turn(graph=graph, user_input=user_input, config=config, thread_id=thread_id):
+        final_messages, last_ai_content = _read_step(step, final_messages, last_ai_content)
+
+    return _collect_answer(final_messages, last_ai_content)
+
+async def aanswer_once_speculative(
+    graph,
+    vector_store,
+    user_input: str,
+    rm_label,
+    candidate_rm_labels,
+    thread_id: str = "abc123",
+    config: dict = None
+):
+    """
+    Run one turn without waiting for the RM label before starting the graph.
+
+    The RM labelling, the query_or_respond LLM call and one retrieval per candidate
+    label (e.g. the last known RM and "UNKNOWN" for an unfiltered search) all start at
+    once. The retrieve tool waits for the label and keeps the speculative retrieval
+    made for it, so one LLM round-trip is taken off the critical path. The speculative
+    searches use the user's own words rather than the query the LLM writes for the tool
+    call; when the final label matches none of the candidates the tool searches as usual.
+
+    :param graph: compiled LangGraph graph
+    :param vector_store: vector store the retrieve tool searches
+    :param user_input(str): user's query
+    :param rm_label(awaitable): coroutine or task resolving to the RM label for this turn
+    :param candidate_rm_labels(iterable): labels to retrieve for speculatively
+    :param thread_id(str): conversation thread id
+    :param config(dict): run config, rm_filter and speculative_retrievals are added to it
+    :return(tuple): answer_once style response dict and the resolved RM label
+    """
+    label_task = asyncio.ensure_future(rm_label)
+    speculative_retrievals = {
+        label: asyncio.create_task(
+            vector_store.asimilarity_search(user_input, k=5, filters=rm_search_filter(label))
+        )
+        for label in set(candidate_rm_labels)
+    }
+    config = config or {}
+    run_config = {
+        **config,
+        "configurable": {
+            **config.get("configurable", {}),
+            "rm_filter": label_task,
+            "speculative_retrievals": speculative_retrievals,
+        },
+    }
+    try:
+        response = await aanswer_once(graph=graph, user_input=user_input, thread_id=thread_id, config=run_config)
+        resolved_rm_label = await label_task
+    finally:
+        for task in [label_task, *speculative_retrievals.values()]:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # mark failures of unused tasks as retrieved so they are not logged as lost
+                task.exception()
+    return response, resolved_rm_label
+
+def _artifact_sources(message):
+    """Names and contents of the documents a retrieve tool message carries as its artifact"""
+    source_names = []
+    source_contents = []
+    # check if the tool has returned an artifact, no artifact attached — treat as no retrieval
+    artifact = getattr(message, "artifact", None)
+    for doc in artifact or []:
+        # Check if the artifact is a langchain_core.documents.base.Document object (retrieval did occur), or a dict (retrieval didn't occur)
+        if isinstance(doc, Document):
+            # retrieval did occur, so return the doc names and contents
+            source_names.append(doc.metadata['title'])
+            source_contents.append(doc.page_content)
+        # Skip non-Document objects without clearing existing sources
+    return source_names, source_contents
+
+async def astream_answer_events(
+    graph,
+    user_input: str,
+    config: dict = None,
+    answer_nodes=("query_or_respond", "generate"),
+    tool_nodes=("query_or_respond",),
+) -> AsyncIterator[tuple]:
+    """
+    Run one turn with graph.astream(stream_mode=["messages", "updates"]) and yield events as they happen.
+
+    Text from tool_nodes is held back until the node's final message is known: text that
+    comes with a tool call (e.g. "Let me check.") is dropped, so the streamed tokens and
+    the final answer match what answer_once returns.
+
+    Yields:
+        ("sources", list of source names) each time the retrieve tool returns,
+        ("token", str) for every piece of answer text generated by an answer node,
+        ("answer", dict) once at the end, shaped like the answer_once response.
+    """
+    answer = ""
+    held_tokens = []
+    source_names = []
+    source_contents = []
+    async for mode, payload in graph.astream(
+        {"messages": [{"role": "user", "content": user_input}]},
+        stream_mode=["messages", "updates"],
+        config=config,
+    ):
+        if mode == "messages":
+            message, metadata = payload
+            node = metadata.get("langgraph_node")
+            if message.type == "tool":
+                source_names, source_contents = _artifact_sources(message)
+                yield "sources", source_names
+            elif (
+                isinstance(message, AIMessage)
+                and node in answer_nodes
+                and isinstance(message.content, str)
+                and message.content
+            ):
+                if node in tool_nodes:
+                    held_tokens.append(message.content)
+                else:
+                    yield "token", message.content
+            continue
+
+        for node, update in payload.items():
+            messages = (update or {}).get("messages") if isinstance(update, dict) else None
+            if node not in answer_nodes or not messages or not isinstance(messages[-1], AIMessage):
+                continue
+            final_message = messages[-1]
+            if node in tool_nodes:
+                tokens, held_tokens = held_tokens, []
+                if final_message.tool_calls:
+                    continue
+                # a model that did not stream only shows up here
+                for token in tokens or [final_message.content]:
+                    if isinstance(token, str) and token:
+                        yield "token", token
+            if isinstance(final_message.content, str):
+                answer = final_message.content
+    yield "answer", {
+        "answer": answer,
+        "source_names": source_names,
+        "source_contents": source_contents
+    }
+
+def _collect_answer(final_messages, last_ai_content):
+    """Pull the answer and the sources of the most recent retrieval out of the final messages"""
     # Helpers to read message fields across LangChain objects/dicts
     def _mtype(m):
         if hasattr(m, "type"):
@@ -146,21 +470,7 @@ def answer_once(
         elif _mtype(message) == "tool":
             # we've found the most recent tool message, so now we need to extract the relevant info
             last_tool_message_found = True
-            # check if the tool has returned an artifact
-            artifact = getattr(message, "artifact", None)
-            if not artifact:
-                # no artifact attached — treat as no retrieval
-                source_names = []
-                source_contents = []
-            else:
-                # loop through all of the chunks that the message has retrieved
-                for doc in artifact:
-                    # Check if the artifact is a langchain_core.documents.base.Document object (retrieval did occur), or a dict (retrieval didn't occur)
-                    if isinstance(doc, Document):
-                        # retrieval did occur, so return the doc names and contents
-                        source_names.append(doc.metadata['title'])
-                        source_contents.append(doc.page_content)
-                    # Skip non-Document objects without clearing existing sources
+            source_names, source_contents = _artifact_sources(message)
         else:
             # this isn't a tool message, so keep looking
             pass
@@ -172,13 +482,32 @@ def answer_once(
     }
     return response
 
-def build_graph(llm, vector_store, checkpointer):
-    # create a properly decorated tool bound to the vector store
-    retrieve_bound = create_bound_retrieve_tool(vector_store)
+def build_graph(llm, vector_store, checkpointer, retrieval_cache=None, history_turns=None, summary_batch_turns=4):
+    """
+    Compile the chat graph.
+
+    :param llm: chat model used by the graph nodes (and for the history summary)
+    :param vector_store: vector store the retrieve tool searches
+    :param checkpointer: checkpointer persisting thread state
+    :param retrieval_cache(RetrievalCache): optional cache for the retrieve tool
+    :param history_turns(int): previous turns sent to the LLM verbatim, None keeps the whole history
+    :param summary_batch_turns(int): older turns collected before they are folded into the summary
+    """
+    # create a properly decorated tool bound to the vector store (and its optional retrieval cache)
+    retrieve_bound = create_bound_retrieve_tool(vector_store, retrieval_cache=retrieval_cache)
     
-    # bind llm and retrieve_tool into the nodes that need them
-    query_node = partial(query_or_respond, llm=llm, retrieve_tool=retrieve_bound)
-    generate_node = partial(generate, llm=llm)
+    # bind llm and retrieve_tool into the nodes that need them,
+    # each node has a sync and an async implementation so the graph works with both stream and astream
+    query_node = RunnableLambda(
+        partial(query_or_respond, llm=llm, retrieve_tool=retrieve_bound),
+        afunc=partial(aquery_or_respond, llm=llm, retrieve_tool=retrieve_bound),
+        name="query_or_respond",
+    )
+    generate_node = RunnableLambda(
+        partial(generate, llm=llm),
+        afunc=partial(agenerate, llm=llm),
+        name="generate",
+    )
     tool_node = ToolNode([retrieve_bound])
 
     graph_builder = StateGraph(AgentState)
@@ -187,7 +516,18 @@ def build_graph(llm, vector_store, checkpointer):
     graph_builder.add_node("tools", tool_node)
     graph_builder.add_node("generate", generate_node)
 
-    graph_builder.set_entry_point("query_or_respond")
+    if history_turns is None:
+        graph_builder.set_entry_point("query_or_respond")
+    else:
+        # trim the history before the first LLM call so the cost of a turn stays flat as the chat grows
+        history_node = RunnableLambda(
+            partial(manage_history, llm=llm, history_turns=history_turns, summary_batch_turns=summary_batch_turns),
+            afunc=partial(amanage_history, llm=llm, history_turns=history_turns, summary_batch_turns=summary_batch_turns),
+            name="manage_history",
+        )
+        graph_builder.add_node("manage_history", history_node)
+        graph_builder.set_entry_point("manage_history")
+        graph_builder.add_edge("manage_history", "query_or_respond")
     graph_builder.add_conditional_edges(
         "query_or_respond",
         tools_condition,
@@ -0,0 +1,148 @@
+import threading
+import numpy as np
+from src.ttl_cache import TTLCache
+
+
+def normalise_retrieval_query(query):
+    """ Lower case and collapse whitespace so near identical tool queries share an entry """
+    return " ".join(str(query).lower().split())
+
+
+class RetrievalCache:
+    """ Cache of retrieve tool results keyed on (RM filter, normalised query)
+
+    Entries live in a size bounded LRU/TTL cache and can be dropped per RM. With
+    similarity_threshold set, a miss on the exact key also checks earlier queries for
+    the same RM: if one has a query embedding within the cosine threshold its documents
+    are reused. Query embeddings come from the embeddings passed in, which should be
+    the cached ones the vector store also uses, so the check costs no extra API call.
+    """
+
+    def __init__(self, maxsize=2048, ttl=60 * 60, embeddings=None, similarity_threshold=None):
+        """
+        :param maxsize(int): maximum number of cached retrievals
+        :param ttl(float): seconds a cached retrieval stays valid
+        :param embeddings: LangChain embeddings used for semantic hits, None for exact matching only
+        :param similarity_threshold(float): minimum cosine similarity for a semantic hit, None to disable
+        """
+        self.maxsize = maxsize
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold if embeddings is not None else None
+        # rm_key -> {normalised query: unit query embedding}
+        self._vectors = {}
+        self._lock = threading.Lock()
+        self.semantic_hits = 0
+
+    @staticmethod
+    def _rm_key(rm_filter):
+        return rm_filter if rm_filter is not None else "UNKNOWN"
+
+    def _exact(self, query, rm_filter):
+        return self.entries.get((self._rm_key(rm_filter), normalise_retrieval_query(query)))
+
+    def _semantic(self, rm_filter, query_vector):
+        rm_key = self._rm_key(rm_filter)
+        with self._lock:
+            known = dict(self._vectors.get(rm_key, {}))
+        if not known:
+            return None
+        queries = list(known.keys())
+        scores = np.stack(list(known.values())) @ query_vector
+        for index in np.argsort(-scores):
+            if scores[index] < self.similarity_threshold:
+                break
+            # the vector may outlive its entry, peek so this check does not skew the exact hit/miss counts
+            docs = self.entries.peek((rm_key, queries[index]))
+            if docs is not None:
+                self.semantic_hits += 1
+                return docs
+        return None
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, query, rm_filter):
+        """ Cached documents for this query and RM filter, None on a miss
+
+        :param query(str): query the retrieve tool was called with
+        :param rm_filter(str): RM label used as the search filter, None or "UNKNOWN" for no filter
+        :return(list | None): documents
+        """
+        docs = self._exact(query, rm_filter)
+        if docs is None and self.similarity_threshold is not None:
+            docs = self._semantic(rm_filter, self._unit(self.embeddings.embed_query(query)))
+        return docs
+
+    async def alookup(self, query, rm_filter):
+        """ Async version of lookup """
+        docs = self._exact(query, rm_filter)
+        if docs is None and self.similarity_threshold is not None:
+            docs = self._semantic(rm_filter, self._unit(await self.embeddings.aembed_query(query)))
+        return docs
+
+    def _remember_vector(self, rm_key, normalised, vector):
+        with self._lock:
+            self._vectors.setdefault(rm_key, {})[normalised] = vector
+            if sum(len(vectors) for vectors in self._vectors.values()) > self.maxsize:
+                # drop vectors whose entries were evicted or expired, across every RM
+                live = set(self.entries.keys())
+                self._vectors = {
+                    key: kept
+                    for key, vectors in self._vectors.items()
+                    if (kept := {q: v for q, v in vectors.items() if (key, q) in live})
+                }
+
+    def store(self, query, rm_filter, docs):
+        """ Cache the documents a search returned
+
+        :param query(str): query the retrieve tool was called with
+        :param rm_filter(str): RM label used as the search filter
+        :param docs(list): documents returned by the vector store
+        """
+        rm_key = self._rm_key(rm_filter)
+        normalised = normalise_retrieval_query(query)
+        self.entries.set((rm_key, normalised), docs)
+        if self.similarity_threshold is not None:
+            self._remember_vector(rm_key, normalised, self._unit(self.embeddings.embed_query(query)))
+
+    async def astore(self, query, rm_filter, docs):
+        """ Async version of store """
+        rm_key = self._rm_key(rm_filter)
+        normalised = normalise_retrieval_query(query)
+        self.entries.set((rm_key, normalised), docs)
+        if self.similarity_threshold is not None:
+            self._remember_vector(rm_key, normalised, self._unit(await self.embeddings.aembed_query(query)))
+
+    def invalidate(self, rm_filter=None):
+        """ Drop cached retrievals for one RM, or everything when rm_filter is None
+
+        :param rm_filter(str): RM label whose entries should be dropped
+        :return(int): number of entries dropped
+        """
+        if rm_filter is None:
+            dropped = len(self.entries)
+            self.entries.clear()
+            with self._lock:
+                self._vectors.clear()
+            return dropped
+        dropped = 0
+        for key in self.entries.keys():
+            if key[0] == rm_filter:
+                self.entries.pop(key)
+                dropped += 1
+        with self._lock:
+            self._vectors.pop(rm_filter, None)
+        return dropped
+
+    def stats(self):
+        """ Hit/miss counters, semantic hits are counted as misses of the exact lookup
+
+        :return(dict): cache metrics
+        """
+        stats = self.entries.stats()
+        stats["semantic_hits"] = self.semantic_hits
+        return stats
@@ -0,0 +1,151 @@
+import numpy as np
+from ai_docs_filterer_for_RAG import DataFilterer
+from src.bm25 import tokenize
+
+# words of a follow-up question that say nothing about which framework is meant
+GENERIC_TERMS = frozenset({
+    "about", "agreement", "agreements", "any", "buy", "buying", "contract", "contracts", "date", "dates",
+    "details", "end", "ends", "framework", "frameworks", "give", "list", "lot", "lots", "more", "much",
+    "price", "prices", "pricing", "rm", "service", "services", "supplier", "suppliers", "tell", "there",
+    "they", "those", "use", "when", "where", "why",
+})
+# a term shared by more than this share of the frameworks does not single one of them out
+MAX_TERM_SHARE = 0.05
+
+
+def framework_route_text(row):
+    """ Text embedded for a framework, its title, keywords and summary """
+    keywords = row.keywords if 'keywords' in row and str(row.keywords).strip() else 'N/A'
+    return f"Title: {row.title}\nKeywords: {keywords}\nSummary: {row.summary}"
+
+
+def framework_route_terms(row):
+    """ Terms of a framework a query must mention before the router may pick it: RM number, title and keywords """
+    keywords = row.keywords if 'keywords' in row and str(row.keywords).strip() else ''
+    return frozenset(tokenize(f"{row.rm_number} {row.title} {keywords}")) - GENERIC_TERMS
+
+
+class RmRouter:
+    """ Fast local RM router that runs before the LLM labeller
+
+    Keeps a row-normalised float32 matrix with one embedding per framework, so routing
+    a query is one query embedding plus a single matrix-vector product. It only answers
+    when the query names a term that is specific to the best framework (its RM number or
+    a rare title/keyword term) and that framework is both similar enough and clearly
+    ahead of the best framework with a different RM number; otherwise it returns None and
+    the caller falls back to the LLM labeller. Follow-ups such as "what are the lots?"
+    never pass the term check, so they reach the labeller and its UNKNOWN answer.
+    """
+
+    def __init__(self, embeddings, ccs_frameworks, top_k=3, min_score=0.8, min_margin=0.08):
+        """
+        :param embeddings: LangChain embeddings (ideally the cached ones) used for frameworks and queries
+        :param ccs_frameworks(pd.DataFrame): frameworks from fetch_all_ccs_frameworks
+        :param top_k(int): number of candidates reported in the reasoning
+        :param min_score(float): minimum cosine similarity of the best framework, ada-002 scores
+            unrelated texts around 0.7 so the default is only a starting point for calibration
+        :param min_margin(float): minimum gap between the best and the runner-up RM
+        """
+        self.embeddings = embeddings
+        self.top_k = top_k
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.short_circuits = 0
+        self.fallbacks = 0
+        self.rebuild(ccs_frameworks)
+
+    def rebuild(self, ccs_frameworks):
+        """ Re-embed the framework directory, call it when the frameworks change
+
+        :param ccs_frameworks(pd.DataFrame): frameworks from fetch_all_ccs_frameworks
+        """
+        texts = [framework_route_text(row) for _, row in ccs_frameworks.iterrows()]
+        matrix = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        rm_numbers = np.asarray(ccs_frameworks["rm_number"].astype(str).tolist())
+        term_sets = [framework_route_terms(row) for _, row in ccs_frameworks.iterrows()]
+        document_frequency = {}
+        for terms in term_sets:
+            for term in terms:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        max_frameworks = max(1, int(len(term_sets) * MAX_TERM_SHARE))
+        rare_terms = frozenset(term for term, count in document_frequency.items() if count <= max_frameworks)
+        term_sets = [terms & rare_terms for terms in term_sets]
+        # published in one assignment, rebuild runs on a worker thread while requests keep routing
+        self._state = (np.ascontiguousarray(matrix / norms), rm_numbers, term_sets, rare_terms)
+
+    @property
+    def matrix(self):
+        return self._state[0]
+
+    @property
+    def rm_numbers(self):
+        return self._state[1]
+
+    def _specific_terms(self, query):
+        """ Terms of the query that point at some framework, empty for a low-information follow-up """
+        return frozenset(tokenize(query)) & self._state[3]
+
+    def _route(self, query_terms, query_vector):
+        # read the state once so the matrix and the RM numbers always come from the same rebuild
+        matrix, rm_numbers, term_sets, _ = self._state
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query_vector)
+        if norm == 0 or not len(rm_numbers):
+            return None
+        scores = matrix @ (query_vector / norm)
+
+        k = min(self.top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        best = top[0]
+        best_rm = rm_numbers[best]
+        # the runner-up must be a different RM, duplicate rows of one framework are not a competitor
+        other_rms = rm_numbers != best_rm
+        runner_up = float(scores[other_rms].max()) if other_rms.any() else -1.0
+        margin = float(scores[best]) - runner_up
+
+        if scores[best] < self.min_score or margin < self.min_margin or not query_terms & term_sets[best]:
+            self.fallbacks += 1
+            return None
+        self.short_circuits += 1
+        candidates = ", ".join(f"{rm_numbers[i]} ({scores[i]:.3f})" for i in top)
+        return DataFilterer(
+            rm_number=str(best_rm),
+            reasoning=f"Embedding router: margin {margin:.3f} over the next RM, top candidates {candidates}",
+        )
+
+    def route(self, query):
+        """ Route a query, None means the router is not confident and the LLM labeller should decide
+
+        :param query(str): user's query
+        :return(DataFilterer | None): RM number and reasoning, or None
+        """
+        query_terms = self._specific_terms(query)
+        if not query_terms:
+            # nothing framework specific to go on, skip the embedding call
+            self.fallbacks += 1
+            return None
+        return self._route(query_terms, self.embeddings.embed_query(query))
+
+    async def aroute(self, query):
+        """ Async version of route """
+        query_terms = self._specific_terms(query)
+        if not query_terms:
+            self.fallbacks += 1
+            return None
+        return self._route(query_terms, await self.embeddings.aembed_query(query))
+
+    def stats(self):
+        """ How often the router answered on its own
+
+        :return(dict): short circuit and fallback counts and the short circuit rate
+        """
+        total = self.short_circuits + self.fallbacks
+        return {
+            "frameworks": len(self.rm_numbers),
+            "short_circuits": self.short_circuits,
+            "fallbacks": self.fallbacks,
+            "short_circuit_rate": round(self.short_circuits / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,425 @@
+import threading
+from langgraph.checkpoint.base import BaseCheckpointSaver, CheckpointTuple, WRITES_IDX_MAP, get_checkpoint_id
+from src.ttl_cache import TTLCache
+
+# checkpoint metadata key marking a messages channel stored as a delta against an earlier checkpoint
+DELTA_KEY = "messages_delta"
+
+
+def _thread_key(config):
+    configurable = config["configurable"]
+    return configurable["thread_id"], configurable.get("checkpoint_ns", "")
+
+
+def _checkpoint_config(thread_key, checkpoint_id):
+    thread_id, checkpoint_ns = thread_key
+    return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}}
+
+
+class _ThreadBuffer:
+    """ Checkpoints and writes of one thread that have not been flushed to the backend yet """
+
+    def __init__(self, parent_checkpoint_id):
+        # last checkpoint the backend has for this thread, parent of the checkpoint written on flush
+        self.parent_checkpoint_id = parent_checkpoint_id
+        # checkpoint_id -> (checkpoint, metadata, parent checkpoint_id)
+        self.checkpoints = {}
+        # checkpoint_id -> [(task_id, channel, value)]
+        self.writes = {}
+        # channels changed by any buffered checkpoint
+        self.changed_channels = set()
+        self.latest = None
+
+
+class WriteBehindSaver(BaseCheckpointSaver):
+    """ Checkpointer that buffers a turn's checkpoint writes in memory and persists them in one go
+
+    LangGraph saves a checkpoint after every node and update_state adds another, each
+    carrying the whole message history. This wrapper keeps those puts and writes in a
+    per-thread buffer that reads are served from, and flush(thread_id) writes only the
+    latest checkpoint of the turn to the backend (any BaseCheckpointSaver: CosmosDBSaver
+    in production, MemorySaver locally). Intermediate checkpoints of the turn are never
+    persisted, and anything not flushed is lost if the process dies mid-turn.
+
+    The messages channel is stored as a delta: which messages of an earlier persisted
+    checkpoint are kept plus the messages that are new. The delta is recorded in the
+    checkpoint metadata and undone on read by walking back to the base checkpoint, with a
+    full snapshot every snapshot_every flushes so the walk stays short. Rebuilt message
+    lists are cached, so reading back a thread this process wrote needs no walk at all.
+    """
+
+    def __init__(self, backend, messages_channel="messages", snapshot_every=20, cache_size=4096, idle_seconds=60 * 60):
+        """
+        :param backend(BaseCheckpointSaver): checkpointer that persists the flushed checkpoints
+        :param messages_channel(str): state channel holding the message history
+        :param snapshot_every(int): maximum number of deltas between two full snapshots
+        :param cache_size(int): number of rebuilt message lists kept in memory
+        :param idle_seconds(float): seconds a thread's last persisted state is remembered for delta encoding
+        """
+        super().__init__(serde=backend.serde)
+        self.backend = backend
+        self.messages_channel = messages_channel
+        self.snapshot_every = snapshot_every
+        self._buffers = {}
+        self._lock = threading.Lock()
+        # (thread_id, checkpoint_ns, checkpoint_id) -> full message list
+        self._messages = TTLCache(maxsize=cache_size)
+        # (thread_id, checkpoint_ns) -> what was last persisted, the base of the next delta
+        self._persisted = TTLCache(maxsize=cache_size, ttl=idle_seconds)
+        self.buffered_puts = 0
+        self.flushes = 0
+        self.deltas = 0
+        self.snapshots = 0
+
+    def get_next_version(self, current, channel):
+        return self.backend.get_next_version(current, channel)
+
+    # ---- buffering ----
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        key = _thread_key(config)
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                buffer = self._buffers[key] = _ThreadBuffer(config["configurable"].get("checkpoint_id"))
+            elif buffer.latest is None:
+                buffer.parent_checkpoint_id = config["configurable"].get("checkpoint_id")
+            # copy the top level so later changes to the graph's dicts cannot leak into the buffer
+            buffer.checkpoints[checkpoint["id"]] = (
+                {**checkpoint, "channel_values": dict(checkpoint["channel_values"])},
+                dict(metadata),
+                config["configurable"].get("checkpoint_id"),
+            )
+            buffer.changed_channels.update(new_versions)
+            buffer.latest = checkpoint["id"]
+            self.buffered_puts += 1
+        return _checkpoint_config(key, checkpoint["id"])
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    def _buffer_writes(self, config, writes, task_id):
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        key = _thread_key(config)
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                # writes against a persisted checkpoint (update_state writes to the current one before saving the next)
+                buffer = self._buffers[key] = _ThreadBuffer(checkpoint_id)
+            pending = buffer.writes.setdefault(checkpoint_id, [])
+            for channel, value in writes:
+                if channel in WRITES_IDX_MAP:
+                    # special channels (errors, interrupts...) hold one value per task, like the backends upsert them
+                    pending[:] = [w for w in pending if not (w[0] == task_id and w[1] == channel)]
+                pending.append((task_id, channel, value))
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        self._buffer_writes(config, writes, task_id)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        self._buffer_writes(config, writes, task_id)
+
+    def _with_buffered_writes(self, stored):
+        """ Add writes still in the buffer to a tuple read from the backend """
+        if stored is None:
+            return None
+        with self._lock:
+            buffer = self._buffers.get(_thread_key(stored.config))
+            buffered = list(buffer.writes.get(stored.config["configurable"]["checkpoint_id"], [])) if buffer else []
+        if not buffered:
+            return stored
+        return stored._replace(pending_writes=list(stored.pending_writes or []) + buffered)
+
+    def _buffered_tuple(self, key, checkpoint_id):
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                return None
+            checkpoint_id = checkpoint_id or buffer.latest
+            if checkpoint_id not in buffer.checkpoints:
+                return None
+            checkpoint, metadata, parent_checkpoint_id = buffer.checkpoints[checkpoint_id]
+            pending_writes = list(buffer.writes.get(checkpoint_id, []))
+        return CheckpointTuple(
+            config=_checkpoint_config(key, checkpoint_id),
+            checkpoint=checkpoint,
+            metadata=metadata,
+            parent_config=_checkpoint_config(key, parent_checkpoint_id) if parent_checkpoint_id else None,
+            pending_writes=pending_writes,
+        )
+
+    # ---- reading from the backend ----
+
+    def _known_messages(self, stored):
+        """ Full messages of a backend tuple if they need no walk, None when its delta base is needed """
+        key = _thread_key(stored.config)
+        cached = self._messages.get((*key, stored.config["configurable"]["checkpoint_id"]))
+        if cached is not None:
+            return cached
+        if not stored.metadata.get(DELTA_KEY):
+            return stored.checkpoint["channel_values"].get(self.messages_channel, [])
+        return None
+
+    def _rebuild(self, stored, chain, messages, remember):
+        """ Apply the deltas in chain (newest first) on top of messages and return stored with its full history """
+        for delta_tuple in reversed(chain):
+            delta = delta_tuple.metadata[DELTA_KEY]
+            appended = delta_tuple.checkpoint["channel_values"].get(self.messages_channel, [])
+            messages = [messages[i] for i in delta["kept"]] + list(appended)
+            self._messages.set((*_thread_key(delta_tuple.config), delta_tuple.config["configurable"]["checkpoint_id"]), messages)
+        key = _thread_key(stored.config)
+        checkpoint_id = stored.config["configurable"]["checkpoint_id"]
+        self._messages.set((*key, checkpoint_id), messages)
+        if remember:
+            self._remember(key, checkpoint_id, stored.checkpoint, stored.metadata, messages)
+        if self.messages_channel not in stored.checkpoint["channel_values"]:
+            return stored
+        checkpoint = {**stored.checkpoint, "channel_values": {**stored.checkpoint["channel_values"], self.messages_channel: messages}}
+        return stored._replace(checkpoint=checkpoint)
+
+    def _delta_base_config(self, delta_tuple):
+        return _checkpoint_config(_thread_key(delta_tuple.config), delta_tuple.metadata[DELTA_KEY]["base"])
+
+    def _rehydrate(self, stored, remember=False):
+        if stored is None:
+            return None
+        chain = []
+        current = stored
+        messages = self._known_messages(current)
+        while messages is None:
+            chain.append(current)
+            current = self.backend.get_tuple(self._delta_base_config(current))
+            if current is None:
+                raise ValueError(f"Delta base of checkpoint {chain[-1].config['configurable']['checkpoint_id']} is missing")
+            messages = self._known_messages(current)
+        return self._rebuild(stored, chain, messages, remember)
+
+    async def _arehydrate(self, stored, remember=False):
+        if stored is None:
+            return None
+        chain = []
+        current = stored
+        messages = self._known_messages(current)
+        while messages is None:
+            chain.append(current)
+            current = await self.backend.aget_tuple(self._delta_base_config(current))
+            if current is None:
+                raise ValueError(f"Delta base of checkpoint {chain[-1].config['configurable']['checkpoint_id']} is missing")
+            messages = self._known_messages(current)
+        return self._rebuild(stored, chain, messages, remember)
+
+    def get_tuple(self, config):
+        buffered = self._buffered_tuple(_thread_key(config), get_checkpoint_id(config))
+        if buffered is not None:
+            return buffered
+        stored = self._rehydrate(self.backend.get_tuple(config), remember=get_checkpoint_id(config) is None)
+        return self._with_buffered_writes(stored)
+
+    async def aget_tuple(self, config):
+        buffered = self._buffered_tuple(_thread_key(config), get_checkpoint_id(config))
+        if buffered is not None:
+            return buffered
+        stored = await self._arehydrate(await self.backend.aget_tuple(config), remember=get_checkpoint_id(config) is None)
+        return self._with_buffered_writes(stored)
+
+    def _buffered_history(self, config, filter, before):
+        """ Buffered checkpoints of the thread, newest first, matching list()'s filter and before """
+        if config is None:
+            return []
+        key = _thread_key(config)
+        with self._lock:
+            buffer = self._buffers.get(key)
+            checkpoint_ids = list(buffer.checkpoints)[::-1] if buffer is not None else []
+        before_id = get_checkpoint_id(before) if before else None
+        history = []
+        for checkpoint_id in checkpoint_ids:
+            # checkpoint ids are time ordered uuid6 strings
+            if before_id is not None and checkpoint_id >= before_id:
+                continue
+            buffered = self._buffered_tuple(key, checkpoint_id)
+            if buffered is not None and all(buffered.metadata.get(k) == v for k, v in (filter or {}).items()):
+                history.append(buffered)
+        return history
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        history = self._buffered_history(config, filter, before)
+        yield from history[:limit]
+        if limit is not None:
+            limit -= len(history)
+            if limit <= 0:
+                return
+        for stored in self.backend.list(config, filter=filter, before=before, limit=limit):
+            yield self._rehydrate(stored)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        history = self._buffered_history(config, filter, before)
+        for buffered in history[:limit]:
+            yield buffered
+        if limit is not None:
+            limit -= len(history)
+            if limit <= 0:
+                return
+        stored_history = self.backend.alist(config, filter=filter, before=before, limit=limit)
+        # CosmosDBSaver.alist returns a coroutine resolving to a list instead of an async iterator
+        if not hasattr(stored_history, "__aiter__"):
+            for stored in await stored_history:
+                yield await self._arehydrate(stored)
+            return
+        async for stored in stored_history:
+            yield await self._arehydrate(stored)
+
+    def delete_thread(self, thread_id):
+        self._forget(thread_id)
+        self.backend.delete_thread(thread_id)
+
+    async def adelete_thread(self, thread_id):
+        self._forget(thread_id)
+        await self.backend.adelete_thread(thread_id)
+
+    def _forget(self, thread_id):
+        with self._lock:
+            for key in [key for key in self._buffers if key[0] == thread_id]:
+                del self._buffers[key]
+        for key in self._persisted.keys():
+            if key[0] == thread_id:
+                self._persisted.pop(key)
+
+    # ---- flushing ----
+
+    def _remember(self, key, checkpoint_id, stored_checkpoint, metadata, messages):
+        """ Record what the backend holds for a thread so the next flush can write a delta against it """
+        self._persisted.set(key, {
+            "checkpoint_id": checkpoint_id,
+            "messages": messages,
+            "stored": stored_checkpoint["channel_values"].get(self.messages_channel),
+            "version": stored_checkpoint["channel_versions"].get(self.messages_channel),
+            "delta": metadata.get(DELTA_KEY),
+        })
+
+    def _encode_messages(self, base, messages, version, changed):
+        """ Stored value and delta metadata (None for a full snapshot) of the messages channel """
+        if not changed and base["version"] == version:
+            # the channel keeps the value it had at the base, version keyed backends do not store it again
+            return base["stored"], base["delta"]
+        depth = base["delta"]["depth"] if base["delta"] else 0
+        if depth >= self.snapshot_every:
+            return messages, None
+        base_index = {message.id: i for i, message in enumerate(base["messages"]) if getattr(message, "id", None)}
+        kept, appended = [], []
+        for message in messages:
+            i = base_index.get(getattr(message, "id", None)) if not appended else None
+            if i is not None and message == base["messages"][i]:
+                kept.append(i)
+            else:
+                # once something new is appended the rest is appended too, so kept + appended keeps the order
+                appended.append(message)
+        if not kept:
+            return messages, None
+        return appended, {"base": base["checkpoint_id"], "kept": kept, "depth": depth + 1}
+
+    def _prepare_flush(self, key, buffer):
+        checkpoint, metadata, _ = buffer.checkpoints[buffer.latest]
+        channel_versions = checkpoint["channel_versions"]
+        new_versions = {channel: channel_versions[channel] for channel in buffer.changed_channels if channel in channel_versions}
+        messages = checkpoint["channel_values"].get(self.messages_channel)
+        stored_checkpoint, delta = checkpoint, None
+        if messages is not None:
+            base = self._persisted.peek(key)
+            if base is not None and base["checkpoint_id"] == buffer.parent_checkpoint_id:
+                stored_messages, delta = self._encode_messages(
+                    base, messages, channel_versions.get(self.messages_channel), self.messages_channel in new_versions
+                )
+                stored_checkpoint = {**checkpoint, "channel_values": {**checkpoint["channel_values"], self.messages_channel: stored_messages}}
+            elif self.messages_channel in channel_versions:
+                # no base to compare with, write the whole history under the current version
+                new_versions[self.messages_channel] = channel_versions[self.messages_channel]
+        if delta is not None:
+            metadata = {**metadata, DELTA_KEY: delta}
+            self.deltas += 1
+        else:
+            self.snapshots += 1
+        return _checkpoint_config(key, buffer.parent_checkpoint_id), stored_checkpoint, metadata, new_versions, messages
+
+    @staticmethod
+    def _writes_to_flush(buffer, checkpoint_id):
+        """ Writes of one checkpoint grouped by task
+
+        Only the writes of the checkpoint that is persisted matter: writes against earlier
+        checkpoints were applied to build the checkpoints that followed them.
+        """
+        writes = {}
+        for task_id, channel, value in buffer.writes.get(checkpoint_id, []):
+            writes.setdefault(task_id, []).append((channel, value))
+        return writes
+
+    def _finish_flush(self, key, buffer, stored_checkpoint, metadata, messages):
+        if messages is not None:
+            self._messages.set((*key, buffer.latest), messages)
+            self._remember(key, buffer.latest, stored_checkpoint, metadata, messages)
+        self._drop_buffer(key, buffer)
+        self.flushes += 1
+
+    def _pending_buffers(self, thread_id):
+        with self._lock:
+            return [(key, buffer) for key, buffer in self._buffers.items() if key[0] == thread_id]
+
+    def _drop_buffer(self, key, buffer):
+        with self._lock:
+            if self._buffers.get(key) is buffer:
+                del self._buffers[key]
+
+    def _needs_base(self, key, buffer):
+        base = self._persisted.peek(key)
+        return buffer.parent_checkpoint_id and (base is None or base["checkpoint_id"] != buffer.parent_checkpoint_id)
+
+    def flush(self, thread_id):
+        """ Persist the latest buffered checkpoint of a thread as one backend write
+
+        :param thread_id(str): conversation thread id
+        """
+        for key, buffer in self._pending_buffers(thread_id):
+            if buffer.latest is None:
+                # only writes, e.g. a turn that failed before saving a checkpoint
+                for checkpoint_id in list(buffer.writes):
+                    for task_id, task_writes in self._writes_to_flush(buffer, checkpoint_id).items():
+                        self.backend.put_writes(_checkpoint_config(key, checkpoint_id), task_writes, task_id)
+                self._drop_buffer(key, buffer)
+                continue
+            if self._needs_base(key, buffer):
+                self._rehydrate(self.backend.get_tuple(_checkpoint_config(key, buffer.parent_checkpoint_id)), remember=True)
+            config, stored_checkpoint, metadata, new_versions, messages = self._prepare_flush(key, buffer)
+            saved_config = self.backend.put(config, stored_checkpoint, metadata, new_versions)
+            for task_id, task_writes in self._writes_to_flush(buffer, buffer.latest).items():
+                self.backend.put_writes(saved_config, task_writes, task_id)
+            self._finish_flush(key, buffer, stored_checkpoint, metadata, messages)
+
+    async def aflush(self, thread_id):
+        """ Async version of flush, call it once at the end of every turn """
+        for key, buffer in self._pending_buffers(thread_id):
+            if buffer.latest is None:
+                for checkpoint_id in list(buffer.writes):
+                    for task_id, task_writes in self._writes_to_flush(buffer, checkpoint_id).items():
+                        await self.backend.aput_writes(_checkpoint_config(key, checkpoint_id), task_writes, task_id)
+                self._drop_buffer(key, buffer)
+                continue
+            if self._needs_base(key, buffer):
+                await self._arehydrate(await self.backend.aget_tuple(_checkpoint_config(key, buffer.parent_checkpoint_id)), remember=True)
+            config, stored_checkpoint, metadata, new_versions, messages = self._prepare_flush(key, buffer)
+            saved_config = await self.backend.aput(config, stored_checkpoint, metadata, new_versions)
+            for task_id, task_writes in self._writes_to_flush(buffer, buffer.latest).items():
+                await self.backend.aput_writes(saved_config, task_writes, task_id)
+            self._finish_flush(key, buffer, stored_checkpoint, metadata, messages)
+
+    def stats(self):
+        """ Write batching metrics
+
+        :return(dict): buffered puts, flushes, delta/snapshot counts and threads waiting for a flush
+        """
+        return {
+            "buffered_puts": self.buffered_puts,
+            "flushes": self.flushes,
+            "deltas": self.deltas,
+            "snapshots": self.snapshots,
+            "pending_threads": len(self._buffers),
+            "message_cache": self._messages.stats(),
+        }
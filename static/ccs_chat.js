@@ -23,6 +23,8 @@
   function init() {
     const userId = getMeta("user-id");
     const apiUrl = getMeta("api-url");
+    // SSE endpoint lives next to /results unless a page overrides it
+    const streamUrl = getMeta("stream-url") || (apiUrl ? `${apiUrl.replace(/\/$/, "")}/stream` : "");
     const downloadUrl = getMeta("download-url");
 
     const chatMessages = document.getElementById("chat-messages");
@@ -80,6 +82,7 @@
       if (!skipStore) {
         pushMessageToHistory({ sender, content, isHtml });
       }
+      return msg;
     }
 
     function hydrateChat() {
@@ -130,6 +133,94 @@
         .replace(/\n/g, '<br>');
     }
 
+    function renderBotResponse(text, sources) {
+      const formattedBody = formatAIResponse(text);
+      let responseHTML = `<div class="msg-content">${formattedBody}</div>`;
+
+      if (sources && sources.length > 0) {
+        responseHTML += `
+          <div style="border-top: 1px solid #ddd; padding-top: 10px; margin-top: 10px;">
+            <p style="font-size: 11px; font-weight: bold; color: #666; margin-bottom: 5px;">SOURCES:</p>
+            <div style="display: flex; flex-direction: column; gap: 5px;">
+              ${sources
+                .map(
+                  (source) =>
+                    `<button onclick="downloadSource('${source}')" class="download-btn">📥 ${source}</button>`
+                )
+                .join("")}
+            </div>
+          </div>`;
+      }
+      return responseHTML;
+    }
+
+    function parseSseFrame(frame) {
+      let event = "message";
+      const dataLines = [];
+      frame.split("\n").forEach((line) => {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) dataLines.push(line.slice(5).trim());
+      });
+      return { event, data: safeJsonParse(dataLines.join("\n")) };
+    }
+
+    // Streams the answer from the SSE endpoint into one bot message as tokens arrive.
+    // Returns false (and leaves nothing on screen) if the stream could not be opened.
+    async function streamQuery(query) {
+      let resp;
+      try {
+        resp = await fetch(streamUrl, {
+          method: "POST",
+          headers: { "Content-Type": "application/json", Accept: "text/event-stream" },
+          body: JSON.stringify({ user_id: userId, query }),
+        });
+      } catch (_) {
+        return false;
+      }
+      if (!resp.ok || !resp.body) return false;
+
+      const msg = appendMessage("", "bot", true, true);
+      const reader = resp.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let answer = "";
+      let sources = [];
+
+      try {
+        while (true) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+
+          let boundary;
+          while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+            const { event, data } = parseSseFrame(buffer.slice(0, boundary));
+            buffer = buffer.slice(boundary + 2);
+            if (!data) continue;
+
+            if (event === "token") {
+              answer += data.token;
+            } else if (event === "sources") {
+              sources = data.source_content || [];
+            } else if (event === "done") {
+              answer = data.AI_response || answer;
+              sources = data.source_content || sources;
+            } else if (event === "error") {
+              answer = answer || "Error connecting to AI service.";
+            }
+            msg.innerHTML = renderBotResponse(answer, sources);
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+          }
+        }
+      } catch (_) {
+        answer = answer || "Error connecting to AI service.";
+        msg.innerHTML = renderBotResponse(answer, sources);
+      }
+
+      pushMessageToHistory({ sender: "bot", content: msg.innerHTML, isHtml: true });
+      return true;
+    }
+
     async function sendQuery() {
       const query = (chatInput.value || "").trim();
       if (!query) return;
@@ -142,6 +233,9 @@
         return;
       }
 
+      // prefer the streaming endpoint, fall back to the single JSON response
+      if (streamUrl && (await streamQuery(query))) return;
+
       try {
         const resp = await fetch(apiUrl, {
           method: "POST",
@@ -150,25 +244,7 @@
         });
 
         const data = await resp.json();
-        const formattedBody = formatAIResponse(data.AI_response);
-        let responseHTML = `<div class="msg-content">${formattedBody}</div>`;
-
-        if (data.source_content && data.source_content.length > 0) {
-          responseHTML += `
-            <div style="border-top: 1px solid #ddd; padding-top: 10px; margin-top: 10px;">
-              <p style="font-size: 11px; font-weight: bold; color: #666; margin-bottom: 5px;">SOURCES:</p>
-              <div style="display: flex; flex-direction: column; gap: 5px;">
-                ${data.source_content
-                  .map(
-                    (source) =>
-                      `<button onclick="downloadSource('${source}')" class="download-btn">📥 ${source}</button>`
-                  )
-                  .join("")}
-              </div>
-            </div>`;
-        }
-
-        appendMessage(responseHTML, "bot", true);
+        appendMessage(renderBotResponse(data.AI_response, data.source_content), "bot", true);
       } catch (e) {
         appendMessage("Error connecting to AI service.", "bot", false);
       }
@@ -22,4 +22,27 @@ User Query: {user_query}
 Document Title: {title}
 Document Content: {description}
 ---
-    """
\ No newline at end of file
+    """
+
+
+def listwise_system_prompt(user_query, candidates):
+    numbered_candidates = "\n".join(
+        f"[{index}] {candidate}" for index, candidate in enumerate(candidates)
+    )
+    return f"""
+    You are an expert document relevance ranker. You are given a user query
+    and a numbered list of commercial agreements (title and description).
+    Rank every agreement from most to least relevant to the user query.
+
+You must only use the facts and context explicitly available in the list. Do not use outside knowledge.
+
+### Output Rules
+1.  Return the number of every agreement exactly once, most relevant first.
+2.  Do not invent numbers that are not in the list.
+
+---
+User Query: {user_query}
+Agreements:
+{numbered_candidates}
+---
+    """